@@ -1,5 +1,8 @@
 import boto3
 import os
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 ##############################################################################
 #
 #  S3 module
@@ -17,30 +20,145 @@ def download_file(objectName, fileName):
    bucketname = os.environ['BUCKET_NAME']
    s3client.download_file(bucketname, objectName, fileName)
 
-# return all objects using paging
-def get_last_two_block_height_from_all_s3_folders_list(Prefix='output/'):
-   folders_list = []
+# block heights of the height_<block_height>/ folders under Prefix, listed after StartAfter if given
+def iter_block_heights(Prefix='output/', StartAfter=None):
    paginator = s3client.get_paginator('list_objects_v2')
    bucketname = os.environ['BUCKET_NAME']
-   pages = paginator.paginate( Bucket = bucketname, Delimiter = '/', Prefix = Prefix)
+   if StartAfter is None:
+      pages = paginator.paginate( Bucket = bucketname, Delimiter = '/', Prefix = Prefix)
+   else:
+      pages = paginator.paginate( Bucket = bucketname, Delimiter = '/', Prefix = Prefix, StartAfter = StartAfter)
    for page in pages:
-      CommonPrefixes = page.get("CommonPrefixes")
+      CommonPrefixes = page.get("CommonPrefixes", [])
       for dir in CommonPrefixes:
         pathname = dir.get("Prefix")
         loc = pathname.find('_')+1
         blockheight = pathname[loc:len(pathname)-1]
-        folders_list.append(int(blockheight))
-   
-   sorted_folders_list = sorted(folders_list)
+        yield int(blockheight)
+
+def list_block_heights(Prefix='output/', StartAfter=None):
+   return list(iter_block_heights(Prefix, StartAfter))
+
+# Heights listed after height_<newest>/, where known heights with fewer digits, which sort in between, are jumped over
+# to the last known one of their number of digits, see last_heights. A jump from height_<k>/ skips the heights of
+# newest's digits that start with the digits of k, at least k*10^n, so it is only taken when that is beyond 2 * newest.
+# @param last_heights: number of digits -> last known height of that many digits
+def list_block_heights_after(Prefix, newest: int, last_heights: dict):
+   folders_list = []
+   start_after = Prefix+'height_'+str(newest)+'/'
+   while start_after is not None:
+      jump = None
+      for height in iter_block_heights(Prefix, start_after):
+         digits = len(str(height))
+         last_height = last_heights.get(str(digits))
+         if digits < len(str(newest)) and last_height is not None and height <= last_height and height * 10**(len(str(newest)) - digits) > 2 * newest:
+            # '0' sorts right after '/', so the listing goes on after every key of the height_<last_height>/ folder
+            jump = Prefix+'height_'+str(last_height)+'0'
+            break
+         folders_list.append(height)
+      start_after = jump
+   return folders_list
+
+# Known heights are kept in cache_filepath, and only the folders after the newest known one are listed.
+# S3 lists keys in string order, which is height order among heights of the same number of digits.
+# Known heights with fewer digits that sort after the newest one are jumped over, see list_block_heights_after,
+# and once the newest height starts with 9 the heights of one more digit, which sort before it,
+# are listed from height_10...0 as well.
+def get_last_two_block_height_from_all_s3_folders_list(Prefix='output/', cache_filepath='./dcl_s3_heights.json'):
+   known_heights = []
+   last_heights = {}
+   if cache_filepath is not None and os.path.exists(cache_filepath):
+      with open(cache_filepath, mode='r', encoding="utf-8") as f:
+         cache = json.load(f)
+      if cache['bucket'] == os.environ['BUCKET_NAME'] and cache['prefix'] == Prefix:
+         known_heights = cache['heights']
+         last_heights = cache.get('last_heights', {})
+
+   if len(known_heights) == 0:
+      folders_list = list_block_heights(Prefix)
+   else:
+      last_height = str(known_heights[-1])
+      folders_list = list_block_heights_after(Prefix, known_heights[-1], last_heights)
+      if last_height[0] == '9':
+         folders_list += list_block_heights(Prefix+'height_1', Prefix+'height_1'+'0'*len(last_height))
+      folders_list = [height for height in folders_list if height > known_heights[-1]]
+
+   sorted_folders_list = sorted(set(known_heights + folders_list))
+   for height in sorted_folders_list:
+      last_heights[str(len(str(height)))] = max(height, last_heights.get(str(len(str(height))), 0))
+   if cache_filepath is not None:
+      with open(cache_filepath + '.tmp', mode='w', encoding="utf-8") as f:
+         json.dump({'bucket': os.environ['BUCKET_NAME'], 'prefix': Prefix, 'heights': sorted_folders_list, 'last_heights': last_heights}, f)
+      os.replace(cache_filepath + '.tmp', cache_filepath)
    return (sorted_folders_list[-2], sorted_folders_list[-1])
    
-def fetch_dcl_files_from_s3(block_height: int):
-   file_list = ['/dcl_root.json','/dcl_pool.json','/dcl_user_liquidities.json','/dcl_user_orders.json','/dcl_pointinfo.json','/dcl_slotbitmap.json','/dcl_vip_users.json']
-   for file in file_list:
-      file_name = 'output/height_'+str(block_height)+file
-      local_path = '.'+file
-      download_file(file_name,local_path)
-                
+DCL_FILES = ['dcl_root.json','dcl_pool.json','dcl_user_liquidities.json','dcl_user_orders.json','dcl_pointinfo.json','dcl_slotbitmap.json','dcl_vip_users.json']
+
+# download objectName into cache_dir/height_<block_height>/fileName unless the cached copy has the same ETag
+# @return path of the cached file
+def fetch_cached_file(objectName, block_height: int, fileName, cache_dir):
+   bucketname = os.environ['BUCKET_NAME']
+   height_dir = os.path.join(cache_dir, 'height_'+str(block_height))
+   cache_path = os.path.join(height_dir, fileName)
+   etag_path = cache_path + '.etag'
+   etag = s3client.head_object(Bucket = bucketname, Key = objectName)['ETag']
+   if os.path.exists(cache_path) and os.path.exists(etag_path):
+      with open(etag_path, mode='r', encoding="utf-8") as f:
+         if f.read() == etag:
+            print("%s unchanged in cache" % objectName)
+            return cache_path
+
+   os.makedirs(height_dir, exist_ok = True)
+   # a partly downloaded file is never taken for a cached one
+   download_file(objectName, cache_path + '.tmp')
+   os.replace(cache_path + '.tmp', cache_path)
+   with open(etag_path + '.tmp', mode='w', encoding="utf-8") as f:
+      f.write(etag)
+   os.replace(etag_path + '.tmp', etag_path)
+   print("%s downloaded" % objectName)
+   return cache_path
+
+# remove the height_<block_height> folders of cache_dir but the newest keep ones, and block_height
+def prune_cache(cache_dir, block_height: int, keep: int):
+   heights = []
+   for name in os.listdir(cache_dir):
+      if name.startswith('height_') and name[len('height_'):].isdigit():
+         heights.append(int(name[len('height_'):]))
+   for height in sorted(heights)[:-keep]:
+      if height != block_height:
+         shutil.rmtree(os.path.join(cache_dir, 'height_'+str(height)))
+
+# hard link path to local_path, replacing it at once, copy when the file system has no hard links
+def place_file(path, local_path):
+   # renaming onto another link of the same file does nothing and would leave the .tmp behind
+   if os.path.exists(local_path) and os.path.samefile(path, local_path):
+      return
+   if os.path.exists(local_path + '.tmp'):
+      os.remove(local_path + '.tmp')
+   try:
+      os.link(path, local_path + '.tmp')
+   except OSError:
+      shutil.copyfile(path, local_path + '.tmp')
+   os.replace(local_path + '.tmp', local_path)
+
+# Fetch the dcl state files of block_height into the working directory.
+# The files download concurrently into cache_dir, where a file whose ETag didn't change is not downloaded again,
+# and only the newest keep_heights heights are kept. Each file is then hard linked into place, so a file in the
+# working directory is never left half written and isn't stored twice. The files are only ever replaced, not written
+# in place, which would change the cached copy too.
+def fetch_dcl_files_from_s3(block_height: int, cache_dir = './dcl_s3_cache', max_workers: int = len(DCL_FILES), keep_heights: int = 2):
+   with ThreadPoolExecutor(max_workers = max_workers) as executor:
+      futures = {}
+      for file in DCL_FILES:
+         file_name = 'output/height_'+str(block_height)+'/'+file
+         futures[file] = executor.submit(fetch_cached_file, file_name, block_height, file, cache_dir)
+      # raise the first error after every download is done, the finished ones stay cached
+      cache_paths = {file: future.result() for file, future in futures.items()}
+
+   for file, cache_path in cache_paths.items():
+      place_file(cache_path, './'+file)
+   prune_cache(cache_dir, block_height, keep_heights)
+
 if __name__ == '__main__':
    (block_height1, block_height2) = get_last_two_block_height_from_all_s3_folders_list()
    #fetch_dcl_files_from_s3(91044865)
@@ -0,0 +1,54 @@
+# Shared parts of the self-checks the modules run with `python <module>.py check`.
+
+import json
+import threading
+import http.server
+
+
+# Request handler of a local stub server, subclasses add do_GET or do_POST.
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+
+    def send_json(self, out):
+        data = json.dumps(out).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+# Local http server of handler_class on a free port, served from a daemon thread.
+# Used as `with StubServer(handler_class) as url:`, the server is shut down when the block ends.
+class StubServer(object):
+
+    def __init__(self, handler_class):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:%d" % self.server.server_port
+
+    def __exit__(self, exc_type, exc, tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Run each check of checks, [(name, check)], and print whether it passed.
+# A check returns True when it passes, one that raises fails.
+def run_self_checks(checks):
+    for (name, check) in checks:
+        try:
+            passed = check()
+        except Exception as e:
+            print(e)
+            passed = False
+        if passed:
+            print("Pass", name)
+        else:
+            print("Error", name)
@@ -9,4 +9,8 @@ class Cfg:
     DCL_CONTRACT_ID="dclv2.ref-labs.near"
     XREF_CONTRACT_ID="xtoken.ref-finance.near"
     REF_CONTRACT_ID="token.v2.ref-finance.near"
-    BLOCK_ID=74607233
\ No newline at end of file
+    DCL_LOG_URL="https://mainnet-indexer.ref-finance.com/get-dcl-pool-log"
+    BLOCK_ID=74607233
+    FT_METADATA_CACHE="./ft_metadata_cache.json"
+    FT_METADATA_TTL=7*24*3600
+    FT_METADATA_OFFLINE=False
\ No newline at end of file
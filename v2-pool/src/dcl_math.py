@@ -1,4 +1,5 @@
 import math
+import functools
 
 LEFT_MOST_POINT = -800000
 RIGHT_MOST_POINT = 800000
@@ -28,12 +29,28 @@ def mul_fraction_ceil(number, _numerator, _denominator):
    else:
       return (res+1)
 
+# compute the price at a given point, served from the sqrt price table when it is enabled
+# @param point: the point
+# @return the price of the point
+def get_sqrt_price(point: int):
+   if _sqrt_price_grids is not None and LEFT_MOST_POINT <= point <= RIGHT_MOST_POINT:
+      for (point_delta, table) in _sqrt_price_grids:
+         if point % point_delta == 0:
+            idx = (point - LEFT_MOST_POINT) // point_delta
+            value = table[idx]
+            if value is None:
+               value = compute_sqrt_price(point)
+               table[idx] = value
+            return value
+      return _sqrt_price_lru(point)
+   return compute_sqrt_price(point)
+
 # sqrt(1.0001^point)
 # from https://github.com/izumiFinance/izumi-swap-core/blob/main/contracts/libraries/LogPowMath.sol#L16-L44
 # compute the price at a given point
 # @param point: the point
 # @return the price of the point
-def get_sqrt_price(point: int):
+def compute_sqrt_price(point: int):
    if point > RIGHT_MOST_POINT or point < LEFT_MOST_POINT:
       print("E202_ILLEGAL_POINT")
       return None
@@ -81,6 +98,28 @@ def update_value(point, value, hex1, hex2):
       value = (value >> 128)
    return value
 
+# opt-in lookup table in front of compute_sqrt_price, results are bit-identical
+# [(point_delta, [sqrt_price_96 or None, ...]), ...], coarse grids first, each slot filled on first use
+_sqrt_price_grids = None
+# LRU cache for points that are not on any registered grid
+_sqrt_price_lru = None
+
+# enable the sqrt price table for get_sqrt_price
+# @param point_deltas: point_delta of the pools in use, one lazily filled grid is kept per point_delta
+# @param lru_size: max number of off-grid points to remember
+def enable_sqrt_price_table(point_deltas = (8, 40, 200), lru_size = 65536):
+   global _sqrt_price_grids, _sqrt_price_lru
+   grids = []
+   for point_delta in sorted(set(point_deltas), reverse = True):
+      grids.append((point_delta, [None] * ((RIGHT_MOST_POINT - LEFT_MOST_POINT) // point_delta + 1)))
+   _sqrt_price_lru = functools.lru_cache(maxsize = lru_size)(compute_sqrt_price)
+   _sqrt_price_grids = grids
+
+def disable_sqrt_price_table():
+   global _sqrt_price_grids, _sqrt_price_lru
+   _sqrt_price_grids = None
+   _sqrt_price_lru = None
+
 
 # floor(log1.0001(sqrtPrice_96))
 #def get_log_sqrt_price_floor( sqrt_price_96: float ):
@@ -382,6 +421,33 @@ def compute_withdraw_x_y( liquidity, left_point, right_point, current_point, poo
 
 
 
+# Function to count the no. of leading zeros of a 256-bit word
+def countLeadingZeros(x):
+   return 256 - x.bit_length()
+
+def countTrailingZeros(v):
+   return (v & -v).bit_length() - 1 
+
+# return Some(0) if 0...01
+# return Some(255) if 1...0
+# fn idx_of_most_left_set_bit(value: U256) -> Option<u8>
+def idx_of_most_left_set_bit(value: int):
+   if ( value == 0 ):
+      return None
+   else:
+      return value.bit_length() - 1
+
+
+# return Some(0) if 01...1
+# return Some(255) if 10...0
+# fn idx_of_most_right_set_bit(value: U256) -> Option<u8>
+def idx_of_most_right_set_bit(value: int):
+   if( value == 0 ):
+      return None
+   else:
+      return countTrailingZeros(value)
+
+
 if __name__ == "__main__":
    '''
    get_sqrt_price(0) = 79228162514264337593543950336
@@ -437,3 +503,43 @@ if __name__ == "__main__":
       print("Error10")
    else:
       print("Pass10")
+
+   import random
+   enable_sqrt_price_table((1, 8, 40, 200), 1024)
+   points = [random.randint(LEFT_MOST_POINT, RIGHT_MOST_POINT) for _ in range(20000)]
+   points += [LEFT_MOST_POINT, RIGHT_MOST_POINT, 0, 1, -1]
+   # twice, so that both the filling and the cached path are compared
+   if all(get_sqrt_price(pt) == compute_sqrt_price(pt) for pt in points + points):
+      print("Pass11")
+   else:
+      print("Error11")
+   enable_sqrt_price_table((40, 200), 1024)
+   if all(get_sqrt_price(pt) == compute_sqrt_price(pt) for pt in points + points):
+      print("Pass12")
+   else:
+      print("Error12")
+   disable_sqrt_price_table()
+
+   # previous shift loop, kept as the reference for countLeadingZeros
+   def count_leading_zeros_by_shift(x):
+      res = 0
+      while ((x & (1 << 255)) == 0):
+         x = (x << 1)
+         res += 1
+      return res
+   # non-zero words only, the shift loop never ends on 0
+   words = [random.getrandbits(k) | (1 << (k - 1)) for k in (random.randint(1, 256) for _ in range(20000))]
+   words += [1, 1 << 255, (1 << 256) - 1]
+   if all(countLeadingZeros(w) == count_leading_zeros_by_shift(w) and idx_of_most_left_set_bit(w) == 255 - count_leading_zeros_by_shift(w) for w in words):
+      print("Pass13")
+   else:
+      print("Error13")
+   if idx_of_most_left_set_bit(0) is None and idx_of_most_right_set_bit(0) is None and countLeadingZeros(0) == 256:
+      print("Pass14")
+   else:
+      print("Error14")
+
+   import timeit
+   t_shift = timeit.timeit(lambda: [count_leading_zeros_by_shift(w) for w in words[:2000]], number = 1)
+   t_bit_length = timeit.timeit(lambda: [countLeadingZeros(w) for w in words[:2000]], number = 1)
+   print("countLeadingZeros on 2000 random words: shift loop %.4fs, bit_length %.4fs" % (t_shift, t_bit_length))
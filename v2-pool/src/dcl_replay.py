@@ -0,0 +1,511 @@
+# replay engine of the dcl pool events fetched from the indexer
+# 1. each event_method is dispatched through a registry to its handler
+# 2. msg and pool_id of an event are resolved at most once, on first use
+# 3. count and time spent are kept per event_method
+# 4. replay_parallel runs the events of each pool in its own process
+# 5. ReplayCheckpoints saves the state of a long replay to resume from
+
+import os
+import sys
+import time
+import json
+import copy
+import gzip
+import pickle
+import stat
+from concurrent.futures import ProcessPoolExecutor
+
+# raw state files kept by Dcl.load_dcl_state, not needed once decoded
+DCL_RAW_STATE = ('dcl_root', 'dcl_pool', 'dcl_user_liquidities', 'dcl_user_orders', 'dcl_pointinfo', 'dcl_slotbitmap', 'dcl_vip_users')
+
+CHECKPOINT_VERSION = 2
+
+
+# One indexer event. msg is parsed and pool_id derived on first use only,
+# handlers that never touch them don't pay for it.
+class ReplayEvent:
+   __slots__ = ('item', 'msg', 'pool_id')
+
+   def __init__(self, item: dict):
+      self.item = item
+      self.msg = None
+      self.pool_id = None
+
+   # @return parsed msg of the event, {} if the event has no msg
+   def get_msg(self):
+      if self.msg is None:
+         if 'msg' in self.item:
+            self.msg = json.loads(self.item['msg'].replace("\\\"", "\""))
+         else:
+            self.msg = {}
+      return self.msg
+
+   # @return pool_id the event belongs to, "" if it can't be told
+   def get_pool_id(self):
+      if self.pool_id is None:
+         item = self.item
+         self.pool_id = ""
+         if "pool_id" in item:
+            self.pool_id = item['pool_id']
+         elif 'order_id' in item:
+            self.pool_id = item['order_id'].split('#')[0]
+         elif 'lpt_id' in item:
+            self.pool_id = item['lpt_id'].split('#')[0]
+         else:
+            msg = self.get_msg()
+            if 'LimitOrderWithSwap' in msg:
+               self.pool_id = msg['LimitOrderWithSwap']['pool_id']
+            elif 'LimitOrder' in msg:
+               self.pool_id = msg['LimitOrder']['pool_id']
+            elif 'Swap' in msg:
+               self.pool_id = msg['Swap']['pool_ids'][0]
+      return self.pool_id
+
+   # @return set of pools the event touches, empty if it can't be told
+   def get_pool_ids(self):
+      pool_ids = set()
+      if self.get_pool_id() != "":
+         pool_ids.add(self.pool_id)
+      msg = self.get_msg()
+      if 'Swap' in msg:
+         pool_ids.update(msg['Swap']['pool_ids'])
+      return pool_ids
+
+
+def replay_liquidity_added(dcl, event: ReplayEvent):
+   item = event.item
+   #add_liquidity(self, user_id, pool_id: str, left_point: int, right_point: int, amount_x: int, amount_y: int, min_amount_x: int, min_amount_y: int )
+   dcl.add_liquidity(item['operator'], event.get_pool_id(), int(item['left_point']), int(item['right_point']), int(item['amount_x']), int(item['amount_y']), int(item['min_amount_x']), int(item['min_amount_y']) )
+
+def replay_liquidity_append(dcl, event: ReplayEvent):
+   item = event.item
+   #append_liquidity(self, user_id, lpt_id, amount_x, amount_y, min_amount_x, min_amount_y )
+   dcl.append_liquidity(item['operator'], item['lpt_id'], int(item['amount_x']), int(item['amount_y']), int(item['min_amount_x']), int(item['min_amount_y']) )
+
+def replay_liquidity_removed(dcl, event: ReplayEvent):
+   item = event.item
+   #remove_liquidity(self, user_id, lpt_id, amount, min_amount_x, min_amount_y)
+   dcl.remove_liquidity(item['operator'], item['lpt_id'], int(item['amount']), 0, 0)
+
+def replay_order_added(dcl, event: ReplayEvent):
+   item = event.item
+   msg = event.get_msg()
+   if 'LimitOrderWithSwap' in msg:
+      #add_order_with_swap(self, client_id, user_id, token_id, amount, pool_id, point, buy_token)
+      dcl.add_order_with_swap("", item['operator'],item['token_contract'], int(item['amount']), event.get_pool_id(), msg['LimitOrderWithSwap']['point'],msg['LimitOrderWithSwap']['buy_token'])
+   elif 'LimitOrder' in msg:
+      #add_order(self, client_id, user_id, token_id, amount, pool_id, point, buy_token, swapped_amount, swap_earn_amount )
+      dcl.add_order("", item['operator'],item['token_id'], int(item['amount']), event.get_pool_id(), item['point'],item['buy_token'],int(item['swapped_amount']), int(item['swap_earn_amount']))
+
+# cancel_order include order_cancelled & order_completed event
+def replay_order_cancelled(dcl, event: ReplayEvent):
+   item = event.item
+   #cancel_order(self, user_id, order_id, amount)
+   if item['amount'] == 'None':
+      dcl.cancel_order(item['operator'], item['order_id'], 0)
+   else:
+      dcl.cancel_order(item['operator'], item['order_id'], int(item['amount']))
+
+# already applied by the order_cancelled event of the same order
+def replay_order_completed(dcl, event: ReplayEvent):
+   pass
+
+def replay_swap(dcl, event: ReplayEvent):
+   item = event.item
+   msg = event.get_msg()
+   if 'LimitOrderWithSwap' in msg: # LimitOrderWithSwap will generate swap event
+      #add_order_with_swap(self, client_id, user_id, token_id, amount, pool_id, point, buy_token)
+      dcl.add_order_with_swap("", item['operator'],item['token_contract'], int(item['amount']), event.get_pool_id(), msg['LimitOrderWithSwap']['point'],msg['LimitOrderWithSwap']['buy_token'])
+   else:
+      #swap(self, pool_ids, input_token: str, input_amount: int, output_token: str, min_output_amount: int )
+      dcl.swap(item['operator'],[event.get_pool_id()], item['token_contract'], int(item['amount']), msg['Swap']['output_token'], int(msg['Swap']['min_output_amount']))
+
+
+# Ids a handler takes from latest_liquidity_id and latest_order_id, told from the log only.
+# @param tx_methods: event_methods of all events of the same tx
+# @return (liquidity id count, order id count)
+def liquidity_added_id_usage(event: ReplayEvent, tx_methods: set):
+   return (1, 0)
+
+def order_added_id_usage(event: ReplayEvent, tx_methods: set):
+   msg = event.get_msg()
+   if 'LimitOrderWithSwap' in msg or 'LimitOrder' in msg:
+      return (0, 1)
+   return (0, 0)
+
+# add_order_with_swap only places an order when the swap doesn't finish,
+# which shows on chain as an order_added event in the same tx
+def swap_id_usage(event: ReplayEvent, tx_methods: set):
+   if 'LimitOrderWithSwap' in event.get_msg() and 'order_added' in tx_methods:
+      return (0, 1)
+   return (0, 0)
+
+
+# event_method -> (handler, record_tx, id_usage)
+# record_tx False leaves the tx out of the replayed txs, so later events of the same tx still replay
+# id_usage None means the handler never takes a liquidity or order id
+REPLAY_HANDLERS = {
+   'liquidity_added': (replay_liquidity_added, True, liquidity_added_id_usage),
+   'liquidity_append': (replay_liquidity_append, True, None),
+   'liquidity_removed': (replay_liquidity_removed, True, None),
+   'order_added': (replay_order_added, True, order_added_id_usage),
+   'order_cancelled': (replay_order_cancelled, True, None),
+   'order_completed': (replay_order_completed, False, None),
+   'swap': (replay_swap, True, swap_id_usage),
+}
+
+# The part of dcl that the events of pool_ids touch, for replaying them in another process.
+# users and liquidity_count start empty, merge_pool_dcl adds them back.
+def split_pool_dcl(dcl, pool_ids, user_liquidities: dict, user_orders: dict):
+   part = copy.copy(dcl)
+   part.pools = {}
+   for pool_id in pool_ids:
+      pool = dcl.get_pool(pool_id)
+      if pool is not None:
+         part.pools[pool_id] = pool
+   part.lazy_pools = {}
+   part.snapshot = None
+   part.user_liquidities = user_liquidities
+   part.user_orders = user_orders
+   part.users = {}
+   part.liquidity_count = 0
+   for name in DCL_RAW_STATE:
+      setattr(part, name, None)
+   return part
+
+# Put a part from split_pool_dcl back into dcl, whose user liquidities and orders of its pools are removed already.
+def merge_pool_dcl(dcl, part):
+   dcl.pools.update(part.pools)
+   dcl.user_liquidities.update(part.user_liquidities)
+   dcl.user_orders.update(part.user_orders)
+   for user_id, user in part.users.items():
+      if user_id in dcl.users:
+         dcl.users[user_id].completed_order_count += user.completed_order_count
+      else:
+         dcl.users[user_id] = user
+   dcl.liquidity_count += part.liquidity_count
+
+# Run in a worker process of ReplayEngine.replay_parallel.
+# @param entries: [(event, liquidity_id, order_id, id_usage)] of a group of pools in log order, liquidity_id and order_id are
+#                 the latest ids a serial replay sees before the event when every event takes the ids of its id_usage
+# @return (dcl, stats), dcl None when an event took other ids than its id_usage
+def replay_pool_events(dcl, handlers: dict, entries: list):
+   engine = ReplayEngine(dcl, handlers)
+   for (event, liquidity_id, order_id, id_usage) in entries:
+      dcl.latest_liquidity_id = liquidity_id
+      dcl.latest_order_id = order_id
+      engine.dispatch(event)
+      if (dcl.latest_liquidity_id - liquidity_id, dcl.latest_order_id - order_id) != id_usage:
+         return (None, None)
+   return (dcl, engine.stats)
+
+# Events of a chunk replayed by ReplayEngine.replay_parallel in one go, grouped by the pools they touch.
+# An event touching several pools joins the groups of these pools, so each group replays in log order in one worker
+# and other pools go on undisturbed.
+class ReplaySegment:
+   def __init__(self, latest_liquidity_id: int, latest_order_id: int):
+      # all events in log order, for the serial replay when ids taken differ from the log
+      self.events = []
+      # events without handler, they only count in the stats
+      self.unhandled = []
+      # pool_id -> group of the pool, [pool_ids, entries], entries as in replay_pool_events with the log position first
+      self.groups = {}
+      # latest ids a serial replay sees after the events so far
+      self.latest_liquidity_id = latest_liquidity_id
+      self.latest_order_id = latest_order_id
+
+   # @param used: (liquidity id count, order id count) the event takes, None for an event without handler
+   def add(self, event: ReplayEvent, pool_ids: set, used):
+      self.events.append(event)
+      if used is None:
+         self.unhandled.append(event)
+         return
+      group = None
+      for pool_id in pool_ids:
+         other = self.groups.get(pool_id)
+         if other is None or other is group:
+            continue
+         if group is None:
+            group = other
+            continue
+         if len(other[1]) > len(group[1]):
+            (group, other) = (other, group)
+         group[0].update(other[0])
+         group[1].extend(other[1])
+         for other_pool_id in other[0]:
+            self.groups[other_pool_id] = group
+      if group is None:
+         group = [set(), []]
+      for pool_id in pool_ids:
+         if pool_id not in group[0]:
+            group[0].add(pool_id)
+            self.groups[pool_id] = group
+      group[1].append((len(self.events), event, self.latest_liquidity_id, self.latest_order_id, used))
+      self.latest_liquidity_id += used[0]
+      self.latest_order_id += used[1]
+
+   # @return [(pool_ids, entries)], entries in log order, biggest groups first
+   def get_groups(self):
+      groups = {id(group): group for group in self.groups.values()}
+      ret = []
+      for (pool_ids, entries) in sorted(groups.values(), key = lambda group: -len(group[1])):
+         entries.sort(key = lambda entry: entry[0])
+         ret.append((pool_ids, [entry[1:] for entry in entries]))
+      return ret
+
+class ReplayEngine:
+   def __init__(self, dcl, handlers: dict = None):
+      self.dcl = dcl
+      self.handlers = dict(REPLAY_HANDLERS if handlers is None else handlers)
+      # event_method -> [count, seconds]
+      self.stats = {}
+      self.duplicate_count = 0
+
+   # plug in the handler of a new event_method, or replace an existing one
+   # handler is called as handler(dcl, event: ReplayEvent), see REPLAY_HANDLERS for record_tx and id_usage
+   # handlers must be module level functions for replay_parallel
+   def register(self, event_method: str, handler, record_tx: bool = True, id_usage = None):
+      self.handlers[event_method] = (handler, record_tx, id_usage)
+
+   # @param item: event from the indexer
+   # @return whether the tx of the event counts as replayed
+   def replay_event(self, item: dict):
+      return self.dispatch(ReplayEvent(item))
+
+   def dispatch(self, event: ReplayEvent):
+      event_method = event.item['event_method']
+      entry = self.handlers.get(event_method)
+      start = time.perf_counter()
+      if entry is not None:
+         entry[0](self.dcl, event)
+      elapsed = time.perf_counter() - start
+      stats = self.stats.get(event_method)
+      if stats is None:
+         stats = self.stats[event_method] = [0, 0.0]
+      stats[0] += 1
+      stats[1] += elapsed
+      return entry is None or entry[1]
+
+   # @param events: iterable of events from the indexer, in log order
+   # @param replayed_txs: container of replayed txs with add(), events of these txs are skipped
+   def replay(self, events, replayed_txs):
+      for item in events:
+         if item['tx'] in replayed_txs:
+            self.duplicate_count += 1
+            continue
+         if self.replay_event(item):
+            replayed_txs.add(item['tx'])
+
+   # Same result as replay, with the events of each pool replayed in a process of its own.
+   # Pools only share the latest liquidity and order ids, so each event gets the ids a serial replay would
+   # give it as told by REPLAY_HANDLERS id_usage. A segment where an event took other ids is replayed again
+   # serially. An event touching several pools, e.g. a multi-hop swap, puts these pools in one process from then on
+   # till the end of the segment. Segments end with the chunk, or at a handled event whose pools can't be told,
+   # which is replayed here in between.
+   # @param chunk_size: events are split into chunks of about chunk_size events at tx boundaries,
+   #                    and pools are sent to the workers once per chunk
+   # @param initializer, initargs: run in each worker process, e.g. enable_sqrt_price_table
+   def replay_parallel(self, events, replayed_txs, max_workers: int = None, chunk_size: int = 100000, initializer = None, initargs = ()):
+      with ProcessPoolExecutor(max_workers = max_workers, initializer = initializer, initargs = initargs) as executor:
+         chunk = []
+         for item in events:
+            if len(chunk) >= chunk_size and item['tx'] != chunk[-1]['tx']:
+               self.replay_chunk(executor, chunk, replayed_txs)
+               chunk = []
+            chunk.append(item)
+         self.replay_chunk(executor, chunk, replayed_txs)
+
+   def replay_chunk(self, executor, chunk: list, replayed_txs):
+      tx_methods = {}
+      for item in chunk:
+         tx_methods.setdefault(item['tx'], set()).add(item['event_method'])
+
+      # which events replay only depends on the log
+      segment = ReplaySegment(self.dcl.latest_liquidity_id, self.dcl.latest_order_id)
+      for item in chunk:
+         if item['tx'] in replayed_txs:
+            self.duplicate_count += 1
+            continue
+         entry = self.handlers.get(item['event_method'])
+         if entry is None or entry[1]:
+            replayed_txs.add(item['tx'])
+         event = ReplayEvent(item)
+         if entry is None:
+            segment.add(event, None, None)
+            continue
+         pool_ids = event.get_pool_ids()
+         if len(pool_ids) > 0:
+            id_usage = entry[2]
+            segment.add(event, pool_ids, (0, 0) if id_usage is None else id_usage(event, tx_methods[item['tx']]))
+            continue
+         self.replay_segment(executor, segment)
+         self.dispatch(event)
+         segment = ReplaySegment(self.dcl.latest_liquidity_id, self.dcl.latest_order_id)
+      self.replay_segment(executor, segment)
+
+   def replay_segment(self, executor, segment: ReplaySegment):
+      dcl = self.dcl
+      groups = segment.get_groups()
+
+      # user liquidities and orders of the pools, indexed once for the segment
+      user_liquidities = {}
+      user_orders = {}
+      if len(groups) > 0:
+         for (pool_ids, _) in groups:
+            for pool_id in pool_ids:
+               user_liquidities[pool_id] = {}
+               user_orders[pool_id] = {}
+         for lpt_id, liquidity in dcl.user_liquidities.items():
+            if liquidity.pool_id in user_liquidities:
+               user_liquidities[liquidity.pool_id][lpt_id] = liquidity
+         for order_id, order in dcl.user_orders.items():
+            if order.pool_id in user_orders:
+               user_orders[order.pool_id][order_id] = order
+
+      futures = []
+      for (pool_ids, entries) in groups:
+         group_liquidities = {}
+         group_orders = {}
+         for pool_id in pool_ids:
+            group_liquidities.update(user_liquidities[pool_id])
+            group_orders.update(user_orders[pool_id])
+         part = split_pool_dcl(dcl, pool_ids, group_liquidities, group_orders)
+         futures.append(executor.submit(replay_pool_events, part, self.handlers, entries))
+      results = []
+      for future in futures:
+         try:
+            results.append(future.result())
+         except Exception as e:
+            # may come from ids taken by another pool, the serial replay raises it again if not
+            print("Error: ", e)
+            results.append((None, None))
+
+      # dcl is left as it was till all groups are back, so a failed segment replays from the start
+      if any(part is None for (part, _) in results):
+         print("[WARNING] ids taken differ from the log, replay %d events serially" % len(segment.events))
+         for event in segment.events:
+            self.dispatch(event)
+         return
+
+      for pool_id in user_liquidities:
+         for lpt_id in user_liquidities[pool_id]:
+            del dcl.user_liquidities[lpt_id]
+         for order_id in user_orders[pool_id]:
+            del dcl.user_orders[order_id]
+      for (part, stats) in results:
+         merge_pool_dcl(dcl, part)
+         for event_method, (count, seconds) in stats.items():
+            total = self.stats.setdefault(event_method, [0, 0.0])
+            total[0] += count
+            total[1] += seconds
+      for event in segment.unhandled:
+         self.dispatch(event)
+      dcl.latest_liquidity_id = segment.latest_liquidity_id
+      dcl.latest_order_id = segment.latest_order_id
+
+   # @return {event_method: {"count", "seconds", "handled"}}
+   def get_stats(self):
+      ret = {}
+      for event_method, (count, seconds) in self.stats.items():
+         ret[event_method] = {"count": count, "seconds": seconds, "handled": event_method in self.handlers}
+      return ret
+
+   def print_stats(self):
+      print("replay stats (%d duplicate events skipped):" % self.duplicate_count)
+      for event_method, (count, seconds) in sorted(self.stats.items(), key=lambda kv: -kv[1][1]):
+         unhandled = "" if event_method in self.handlers else " (no handler)"
+         print("   %s: %d events, %.3fs, %.1fus/event%s" % (event_method, count, seconds, seconds * 1e6 / count, unhandled))
+
+
+# Full Dcl state and replayed txs of a long replay, saved every few pages so it can resume after a crash.
+# dir/checkpoint_<block height>.pkl.gz holds the state after all events up to that block.
+# save forks and the child pickles its copy-on-write view of the state, so replay only stalls for the fork.
+# Without os.fork the checkpoint is written in place.
+# Checkpoints are plain pickle and loading one runs whatever code it holds, so checkpoint_dir must be trusted:
+# load_latest refuses a directory or file that another user owns or that group or others can write.
+class ReplayCheckpoints:
+   def __init__(self, checkpoint_dir = './dcl_checkpoints', keep: int = 2):
+      self.checkpoint_dir = checkpoint_dir
+      self.keep = keep
+      self.writer_pid = None
+
+   def get_filepath(self, block_height: int):
+      return os.path.join(self.checkpoint_dir, "checkpoint_%d.pkl.gz" % block_height)
+
+   # @return block heights of the saved checkpoints, ascending
+   def list_block_heights(self):
+      if not os.path.exists(self.checkpoint_dir):
+         return []
+      block_heights = []
+      for name in os.listdir(self.checkpoint_dir):
+         if name.startswith("checkpoint_") and name.endswith(".pkl.gz"):
+            block_heights.append(int(name[len("checkpoint_"):-len(".pkl.gz")]))
+      return sorted(block_heights)
+
+   # @param replayed_txs: RecentTxs
+   def save(self, dcl, replayed_txs, block_height: int):
+      self.wait()
+      if not hasattr(os, 'fork'):
+         self.write(dcl, replayed_txs, block_height)
+         return
+      sys.stdout.flush()
+      pid = os.fork()
+      if pid == 0:
+         status = 0
+         try:
+            self.write(dcl, replayed_txs, block_height)
+         except BaseException as e:
+            print("Error: ", e)
+            status = 1
+         sys.stdout.flush()
+         os._exit(status)
+      self.writer_pid = pid
+
+   # wait until the checkpoint being written is on disk
+   def wait(self):
+      if self.writer_pid is None:
+         return
+      (_, status) = os.waitpid(self.writer_pid, 0)
+      self.writer_pid = None
+      if status != 0:
+         print("[WARNING] checkpoint writer exited with status %d" % status)
+
+   def write(self, dcl, replayed_txs, block_height: int):
+      dcl = copy.copy(dcl)
+      for name in DCL_RAW_STATE:
+         setattr(dcl, name, None)
+      state = {"version": CHECKPOINT_VERSION, "block_height": block_height, "dcl": dcl, "replayed_txs": replayed_txs.get_state()}
+      os.makedirs(self.checkpoint_dir, exist_ok = True)
+      filepath = self.get_filepath(block_height)
+      data = gzip.compress(pickle.dumps(state, protocol = pickle.HIGHEST_PROTOCOL), compresslevel = 1)
+      with open(filepath + ".tmp", 'wb') as f:
+         f.write(data)
+      os.replace(filepath + ".tmp", filepath)
+      print("%s saved" % filepath)
+      if self.keep > 0:
+         for old_block_height in self.list_block_heights()[:-self.keep]:
+            os.remove(self.get_filepath(old_block_height))
+
+   # @return whether only the current user can have written path
+   def is_trusted(self, path):
+      if not hasattr(os, 'getuid'):
+         return True
+      st = os.stat(path)
+      return st.st_uid == os.getuid() and (st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)) == 0
+
+   # @param min_block_height: older checkpoints are ignored
+   # @return (block_height, dcl, replayed_txs state) of the newest checkpoint, None if there is none
+   def load_latest(self, min_block_height: int = 0):
+      block_heights = self.list_block_heights()
+      if len(block_heights) == 0 or block_heights[-1] < min_block_height:
+         return None
+      filepath = self.get_filepath(block_heights[-1])
+      for path in (self.checkpoint_dir, filepath):
+         if not self.is_trusted(path):
+            raise Exception("Checkpoint %s is writable by other users, not loading it" % path)
+      with open(filepath, 'rb') as f:
+         state = pickle.loads(gzip.decompress(f.read()))
+      if state["version"] != CHECKPOINT_VERSION:
+         raise Exception("Unsupported checkpoint version %s of %s" % (state["version"], filepath))
+      print("%s loaded" % filepath)
+      return (state["block_height"], state["dcl"], state["replayed_txs"])
@@ -16,13 +16,20 @@ import os
 import sys
 import time
 import datetime
+import gc
 import json
 from dcl_swap import *
 from dcl_common import *
 from dcl_math import *
 import copy
+import bisect
+import itertools
+import collections
 from aws_s3_client import get_last_two_block_height_from_all_s3_folders_list, fetch_dcl_files_from_s3
-from utils import gen_info_filepath, get_ft_metadata
+from utils import gen_info_filepath, get_cached_ft_metadata, encode_stats_runs, iter_dcl_pool_log
+from dcl_replay import ReplayEngine, ReplayCheckpoints
+from dcl_snapshot import SnapshotReader, SnapshotWriter, MISSING
+from check_helpers import run_self_checks
 from config import Cfg
 
 
@@ -39,43 +46,65 @@ def OpenFile(filepath):
    return json_obj
 
 def default(instance):
+    if hasattr(instance, '__slots__'):
+        return {k: getattr(instance, k)
+                for k in instance.__slots__
+                if not str(k).startswith('_')}
     return {k: v
             for k, v in vars(instance).items()
             if not str(k).startswith('_')}
 
-############################################################################################
-
-# Function to count the no. of leading zeros
-def countLeadingZeros(x):
-    # Keep shifting x by one until leftmost bit does not become 1.
-    total_bits = 256
-    res = 0
-    while ((x & (1 << (total_bits - 1))) == 0):
-        x = (x << 1)
-        res += 1
-    return res
-
-def countTrailingZeros(v):
-    return (v & -v).bit_length() - 1 
-
-# return Some(0) if 0...01
-# return Some(255) if 1...0
-# fn idx_of_most_left_set_bit(value: U256) -> Option<u8>
-def idx_of_most_left_set_bit(value: int):
-   if ( value == 0 ):
-      return None
+# same text as json.dump(obj, f, indent = 2, sort_keys = True) for a dict of dicts,
+# but each distinct value object is encoded only once, which matters when many keys share one value
+def dump_dict_of_dicts(obj: dict, f):
+   if not obj:
+      f.write("{}")
+      return
+   encoded = {}
+   sep = "{\n"
+   for key in sorted(obj.keys()):
+      value = obj[key]
+      text = encoded.get(id(value))
+      if text is None:
+         text = json.dumps(value, indent = 2, sort_keys = True).replace("\n", "\n  ")
+         encoded[id(value)] = text
+      f.write(sep + "  " + json.dumps(key) + ": " + text)
+      sep = ",\n"
+   f.write("\n}")
+
+# copy the known fields of a __slots__ class from its json shape, missing fields keep their default
+def load_slots(instance, data: dict):
+   for k in instance.__slots__:
+      if k in data:
+         setattr(instance, k, data[k])
+
+# shallow copy of a __slots__ class, quicker than the generic copy.copy path
+def copy_slots(instance):
+   cls = instance.__class__
+   other = cls.__new__(cls)
+   for k in cls.__slots__:
+      setattr(other, k, getattr(instance, k))
+   return other
+
+# pickle state of a __slots__ class as a tuple of its fields, smaller and quicker than the default dict
+def get_slots_state(instance):
+   return tuple(getattr(instance, k) for k in instance.__slots__)
+
+def set_slots_state(instance, state: tuple):
+   for (k, v) in zip(instance.__slots__, state):
+      setattr(instance, k, v)
+
+# set field k of each object to the value in the same row of values, rows with MISSING keep their value.
+# One map per field instead of a loop per object, for building objects from snapshot columns.
+def set_column(objs: list, k: str, values: list):
+   if MISSING in values:
+      for (obj, v) in zip(objs, values):
+         if v is not MISSING:
+            setattr(obj, k, v)
    else:
-      return (255 - countLeadingZeros(value))
-
+      collections.deque(map(setattr, objs, itertools.repeat(k), values), maxlen = 0)
 
-# return Some(0) if 01...1
-# return Some(255) if 10...0
-# fn idx_of_most_right_set_bit(value: U256) -> Option<u8>
-def idx_of_most_right_set_bit(value: int):
-   if( value == 0 ):
-      return None
-   else:
-      return countTrailingZeros(value)
+############################################################################################
 
 class RangeInfo:
    def __init__(self):
@@ -154,12 +183,23 @@ class UserLiquidity:
 
 
 class LiquidityData:
+   __slots__ = ('liquidity_sum', 'liquidity_delta', 'acc_fee_x_out_128', 'acc_fee_y_out_128')
+
    def __init__(self):
       self.liquidity_sum = 0
       self.liquidity_delta = 0
       self.acc_fee_x_out_128 = 0
       self.acc_fee_y_out_128 = 0
    
+   def __copy__(self):
+      return copy_slots(self)
+
+   def __getstate__(self):
+      return get_slots_state(self)
+
+   def __setstate__(self, state):
+      set_slots_state(self, state)
+
    def pass_endpoint(self, fee_scale_x_128: int, fee_scale_y_128: int):
       self.acc_fee_x_out_128 = fee_scale_x_128 - self.acc_fee_x_out_128
       self.acc_fee_y_out_128 = fee_scale_y_128 - self.acc_fee_y_out_128
@@ -173,6 +213,10 @@ class LiquidityData:
       print("----------------dump LiquidityData completed-------------------")
 
 class OrderData:
+   __slots__ = ('selling_x', 'earn_y', 'earn_y_legacy', 'acc_earn_y', 'acc_earn_y_legacy',
+                'selling_y', 'earn_x', 'earn_x_legacy', 'acc_earn_x', 'acc_earn_x_legacy',
+                'user_order_count')
+
    def __init__(self):
       self.selling_x = 0
       self.earn_y = 0
@@ -188,6 +232,15 @@ class OrderData:
       
       self.user_order_count = 0
 
+   def __copy__(self):
+      return copy_slots(self)
+
+   def __getstate__(self):
+      return get_slots_state(self)
+
+   def __setstate__(self, state):
+      set_slots_state(self, state)
+
    def dump(self):
       print("----------------dump OrderData-------------------")
       print("selling_x:",self.selling_x)
@@ -203,12 +256,23 @@ class OrderData:
       print("----------------dump OrderData completed-------------------")
 
 class PointData:
+   __slots__ = ('liquidity_data', 'order_data')
+
    def __init__(self):
       #self.liquidity_data = LiquidityData()
       #self.order_data = OrderData()
       self.liquidity_data = None
       self.order_data = None
 
+   def __copy__(self):
+      return copy_slots(self)
+
+   def __getstate__(self):
+      return get_slots_state(self)
+
+   def __setstate__(self, state):
+      set_slots_state(self, state)
+
    # see if corresponding bit in slot_bitmap should be set
    def has_active_liquidity(self):
       if self.liquidity_data:
@@ -249,6 +313,10 @@ class PointData:
    ####################################
 
 class PointStats:
+   __slots__ = ('liquidity_volume_x_in', 'liquidity_volume_y_in', 'liquidity_volume_x_out', 'liquidity_volume_y_out',
+                'order_volume_x_in', 'order_volume_y_in', 'order_volume_x_out', 'order_volume_y_out',
+                'fee_x', 'fee_y', 'p_fee_x', 'p_fee_y')
+
    def __init__(self):
       # for user requirement.
       self.liquidity_volume_x_in = 0
@@ -264,16 +332,25 @@ class PointStats:
       self.p_fee_x = 0
       self.p_fee_y = 0
       
+   def __copy__(self):
+      return copy_slots(self)
+
+   def __getstate__(self):
+      return get_slots_state(self)
+
+   def __setstate__(self, state):
+      set_slots_state(self, state)
+
    def dump(self):
       print("----------------dump PointStats-------------------")
-      print("liquidity_volume_x_in:",self.volume_x_in)
-      print("liquidity_volume_y_in:",self.volume_y_in)
-      print("liquidity_volume_x_out:",self.volume_x_out)
-      print("liquidity_volume_y_out:",self.volume_y_out)
-      print("order_volume_x_in:",self.volume_x_in)
-      print("order_volume_y_in:",self.volume_y_in)
-      print("order_volume_x_out:",self.volume_x_out)
-      print("order_volume_y_out:",self.volume_y_out)
+      print("liquidity_volume_x_in:",self.liquidity_volume_x_in)
+      print("liquidity_volume_y_in:",self.liquidity_volume_y_in)
+      print("liquidity_volume_x_out:",self.liquidity_volume_x_out)
+      print("liquidity_volume_y_out:",self.liquidity_volume_y_out)
+      print("order_volume_x_in:",self.order_volume_x_in)
+      print("order_volume_y_in:",self.order_volume_y_in)
+      print("order_volume_x_out:",self.order_volume_x_out)
+      print("order_volume_y_out:",self.order_volume_y_out)
       print("fee_x:",self.fee_x)
       print("fee_y:",self.fee_y)
       print("----------------dump PointStats completed-------------------")      
@@ -305,6 +382,38 @@ class PointInfo:
    def __init__(self):
       self.data = {}
       self.stats_data = {}
+      # cached PointColumns of data, reset to None by every accessor that may change a point
+      self.columns = None
+
+   # pickle the points as tuples of their fields, a few times quicker and smaller than an object per point
+   def __getstate__(self):
+      state = self.__dict__.copy()
+      state['data'] = [(point, None if point_data.liquidity_data is None else get_slots_state(point_data.liquidity_data),
+                        None if point_data.order_data is None else get_slots_state(point_data.order_data))
+                       for point, point_data in self.data.items()]
+      state['stats_data'] = [(point, get_slots_state(point_stats)) for point, point_stats in self.stats_data.items()]
+      state['columns'] = None
+      return state
+
+   def __setstate__(self, state):
+      data = {}
+      for (point, liquidity_state, order_state) in state['data']:
+         point_data = PointData()
+         if liquidity_state is not None:
+            point_data.liquidity_data = LiquidityData.__new__(LiquidityData)
+            set_slots_state(point_data.liquidity_data, liquidity_state)
+         if order_state is not None:
+            point_data.order_data = OrderData.__new__(OrderData)
+            set_slots_state(point_data.order_data, order_state)
+         data[point] = point_data
+      stats_data = {}
+      for (point, stats_state) in state['stats_data']:
+         stats_data[point] = PointStats.__new__(PointStats)
+         set_slots_state(stats_data[point], stats_state)
+      self.__dict__.update(state)
+      self.data = data
+      self.stats_data = stats_data
+      self.columns = None
    
    def dump(self):
       print("----------------dump point_info-------------------")
@@ -335,117 +444,160 @@ class PointInfo:
       print("----------------dump point_info completed-------------------")
 
    # 统计所有endpoint上的liquidity, x_in, x_out, y_in, y_out, fee_x, fee_y
-   def dump_stats_data(self, current_point: int, point_delta: int, pool_fee: int, protocol_fee_rate: int, x_decimal: int, y_decimal: int):
+   def dump_stats_data(self, current_point: int, point_delta: int, pool_fee: int, protocol_fee_rate: int, x_decimal: int, y_decimal: int, save_file: bool = True):
       stats_dict = {}
-      # sort at first
-      self.data = json.loads(json.dumps(self.data, sort_keys = True, default=default))
-      
-      # deal with liquidity & limit order
+      price_scale = 10**(x_decimal - y_decimal)
+
+      def new_stats(point: int):
+         stats = vars(StatsResult())
+         stats['p'] = (1.0001**point) * price_scale
+         return stats
+
+      # deal with liquidity & limit order, in ascending order of points
       acc_delta = 0
       last_point = -400001
-      for point, data in self.data.items():
+      # gap points after last_point all get the same copy of its stats, taken once and shared
+      fill_stats = None
+      fill_from = 0
+      for point in sorted(self.data.keys()):
+         data = self.data[point]
+         key = str(point)
          # liquidity
-         if last_point > -400001 and last_point < int(point):
-            for pt in range(last_point+point_delta, int(point),point_delta):
-               stats_dict[str(pt)] = copy.deepcopy(stats_dict[str(last_point)])
-
-         if data['liquidity_data'] and len(data['liquidity_data']) > 0: # data['liquidity_data'] could be None and empty
-            acc_delta += data['liquidity_data']['liquidity_delta']
+         if last_point > -400001 and last_point < point:
+            if fill_stats is None:
+               fill_stats = dict(stats_dict[str(last_point)])
+               fill_from = last_point + point_delta
+            for pt in range(fill_from, point, point_delta):
+               stats_dict[str(pt)] = fill_stats
+            fill_from = max(fill_from, point)
+
+         if data.liquidity_data:
+            acc_delta += data.liquidity_data.liquidity_delta
          if acc_delta > 0:
-            if point not in stats_dict:
-               stats_dict[point] = StatsResult()
-               stats_dict[point].p = (1.0001**int(point)) * (10**(x_decimal - y_decimal))
-               
-            stats_dict[point].l = acc_delta
-            (stats_dict[point].tvl_x_l, stats_dict[point].tvl_y_l) = compute_deposit_x_y(acc_delta, int(point), int(point)+point_delta, current_point)
-            stats_dict[point].tvl_x_l = stats_dict[point].tvl_x_l / 10**x_decimal
-            stats_dict[point].tvl_y_l = stats_dict[point].tvl_y_l / 10**y_decimal
+            if key not in stats_dict:
+               stats_dict[key] = new_stats(point)
+
+            stats = stats_dict[key]
+            stats['l'] = acc_delta
+            (tvl_x_l, tvl_y_l) = compute_deposit_x_y(acc_delta, point, point+point_delta, current_point)
+            stats['tvl_x_l'] = tvl_x_l / 10**x_decimal
+            stats['tvl_y_l'] = tvl_y_l / 10**y_decimal
             
-            last_point = int(point)
+            last_point = point
+            fill_stats = None
          
          # limit order
-         if data['order_data']:
-            if point not in stats_dict:
-               stats_dict[point] = StatsResult()            
-               stats_dict[point].p = (1.0001**int(point)) * (10**(x_decimal - y_decimal))
+         if data.order_data:
+            if key not in stats_dict:
+               stats_dict[key] = new_stats(point)
 
-            stats_dict[point].tvl_x_o = data['order_data']['selling_x'] / 10**x_decimal
-            stats_dict[point].tvl_y_o = data['order_data']['selling_y'] / 10**y_decimal
+            stats_dict[key]['tvl_x_o'] = data.order_data.selling_x / 10**x_decimal
+            stats_dict[key]['tvl_y_o'] = data.order_data.selling_y / 10**y_decimal
       
       # deal with token_in, token_out, fee_x, fee_y etc
       for point, data in self.stats_data.items():
-         if str(point) not in stats_dict:
-            stats_dict[str(point)] = StatsResult()
-            stats_dict[str(point)].p = (1.0001**int(point)) * (10**(x_decimal - y_decimal))
-         stats_dict[str(point)].vol_x_in_l = data.liquidity_volume_x_in / 10**x_decimal
-         stats_dict[str(point)].vol_y_in_l = data.liquidity_volume_y_in / 10**y_decimal
-         stats_dict[str(point)].vol_x_out_l = data.liquidity_volume_x_out / 10**x_decimal
-         stats_dict[str(point)].vol_y_out_l = data.liquidity_volume_y_out / 10**y_decimal
-         stats_dict[str(point)].vol_x_in_o = data.order_volume_x_in / 10**x_decimal
-         stats_dict[str(point)].vol_y_in_o = data.order_volume_y_in / 10**y_decimal
-         stats_dict[str(point)].vol_x_out_o = data.order_volume_x_out / 10**x_decimal
-         stats_dict[str(point)].vol_y_out_o = data.order_volume_y_out / 10**y_decimal
-         stats_dict[str(point)].fee_x = data.fee_x / 10**x_decimal
-         stats_dict[str(point)].fee_y = data.fee_y / 10**x_decimal
-         stats_dict[str(point)].p_fee_x = data.p_fee_x / 10**x_decimal
-         stats_dict[str(point)].p_fee_y = data.p_fee_y / 10**x_decimal
+         key = str(point)
+         if key not in stats_dict:
+            stats = new_stats(point)
+         else:
+            # may be a shared gap fill
+            stats = dict(stats_dict[key])
+         stats_dict[key] = stats
+         stats['vol_x_in_l'] = data.liquidity_volume_x_in / 10**x_decimal
+         stats['vol_y_in_l'] = data.liquidity_volume_y_in / 10**y_decimal
+         stats['vol_x_out_l'] = data.liquidity_volume_x_out / 10**x_decimal
+         stats['vol_y_out_l'] = data.liquidity_volume_y_out / 10**y_decimal
+         stats['vol_x_in_o'] = data.order_volume_x_in / 10**x_decimal
+         stats['vol_y_in_o'] = data.order_volume_y_in / 10**y_decimal
+         stats['vol_x_out_o'] = data.order_volume_x_out / 10**x_decimal
+         stats['vol_y_out_o'] = data.order_volume_y_out / 10**y_decimal
+         stats['fee_x'] = data.fee_x / 10**x_decimal
+         stats['fee_y'] = data.fee_y / 10**x_decimal
+         stats['p_fee_x'] = data.p_fee_x / 10**x_decimal
+         stats['p_fee_y'] = data.p_fee_y / 10**x_decimal
 
          
       # verify the fee_x based on vol_x_in_l,vol_x_in_o and fee_y based on vol_x_in_o,vol_y_in_o
       for point, data in self.stats_data.items():
-         pool_fee_x = (stats_dict[str(point)].vol_x_in_l + stats_dict[str(point)].vol_x_in_o) * pool_fee // 10**6
-         pool_fee_y = (stats_dict[str(point)].vol_y_in_l + stats_dict[str(point)].vol_y_in_o) * pool_fee // 10**6
+         pool_fee_x = (stats_dict[str(point)]['vol_x_in_l'] + stats_dict[str(point)]['vol_x_in_o']) * pool_fee // 10**6
+         pool_fee_y = (stats_dict[str(point)]['vol_y_in_l'] + stats_dict[str(point)]['vol_y_in_o']) * pool_fee // 10**6
          
          protocol_fee_x = pool_fee_x * protocol_fee_rate // BP_DENOM
          protocol_fee_y = pool_fee_y * protocol_fee_rate // BP_DENOM
          
-         total_fee_x = stats_dict[str(point)].fee_x + stats_dict[str(point)].p_fee_x
-         total_fee_y = stats_dict[str(point)].fee_y + stats_dict[str(point)].p_fee_y
+         total_fee_x = stats_dict[str(point)]['fee_x'] + stats_dict[str(point)]['p_fee_x']
+         total_fee_y = stats_dict[str(point)]['fee_y'] + stats_dict[str(point)]['p_fee_y']
          
          if math.fabs(total_fee_x - pool_fee_x) > 1 / 10**x_decimal:
             print(point," pool_fee_x: ", str(pool_fee_x), ", total_fee_x: ", str(total_fee_x))
          if math.fabs(total_fee_y - pool_fee_y) > 1 / 10**y_decimal:
             print(point," pool_fee_y: ", pool_fee_y, ", total_fee_y: ", str(total_fee_y))
 
-      # re-sort
-      stats_dict = json.loads(json.dumps(stats_dict, sort_keys = True, default=default))
-      with open("stats_dict.json", mode='w', encoding="utf-8") as f:
-        json.dump(stats_dict, f, indent = 2, sort_keys = True)
+      # sort by key as the json output does
+      stats_dict = dict(sorted(stats_dict.items()))
+      if save_file:
+         with open("stats_dict.json", mode='w', encoding="utf-8") as f:
+           dump_dict_of_dicts(stats_dict, f)
       return stats_dict
 
 
       
    def load_point_info(self, point_info ):
+      self.columns = None
       for key, value in point_info.items():
          point_data = PointData()
          point_data.liquidity_data = LiquidityData()
          point_data.order_data = OrderData()
          
          if len(value['liquidity_data']) > 0: # if value['liquidity_data'] is not empty
-            point_data.liquidity_data.__dict__ = value['liquidity_data']
+            load_slots(point_data.liquidity_data, value['liquidity_data'])
          if len(value['order_data']) > 0: # if value['order_data'] is not empty
-            point_data.order_data.__dict__ = value['order_data']
+            load_slots(point_data.order_data, value['order_data'])
          self.data[int(key)] = point_data # change the key from str to int
+
+   # same as load_point_info, from a pointinfo table of the binary snapshot, see convert_dcl_state
+   def load_point_columns(self, columns: dict):
+      self.columns = None
+      rows = len(columns['point'])
+      liquidity_datas = [LiquidityData.__new__(LiquidityData) for _ in range(rows)]
+      for k in LiquidityData.__slots__:
+         set_column(liquidity_datas, k, columns['liquidity_data.' + k])
+      order_datas = [OrderData.__new__(OrderData) for _ in range(rows)]
+      for k in OrderData.__slots__:
+         set_column(order_datas, k, columns['order_data.' + k])
+      point_datas = [PointData.__new__(PointData) for _ in range(rows)]
+      set_column(point_datas, 'liquidity_data', liquidity_datas)
+      set_column(point_datas, 'order_data', order_datas)
+      self.data.update(zip(columns['point'], point_datas))
    
    def remove(self, point: int):
+      self.columns = None
       self.data.pop(point, None)
    
+   # read only lookup of the PointData at point, unlike get_point_data it keeps the cached columns
+   def peek_point_data(self, point: int):
+      return self.data.get(point)
+
    def get_point_data(self, point: int):
+      self.columns = None
       if point in self.data.keys():
          return self.data[point]
       else:
          return None
 
    def get_point_data_or_default(self, point: int):
+      self.columns = None
       if point in self.data.keys():
          return self.data[point]
       else:
          return PointData()
 
    def set_point_data(self, point: int, point_data):
+      self.columns = None
       self.data[point] = point_data
    
    def get_liquidity_data(self, point: int):
+      self.columns = None
       if point not in self.data.keys():
          self.data[point] = PointData()
          self.data[point].liquidity_data = LiquidityData()
@@ -455,11 +607,13 @@ class PointInfo:
       return self.data[point].liquidity_data
 
    def set_liquidity_data(self, point: int, liquidity_data):
+      self.columns = None
       if point not in self.data.keys():
          self.data[point] = PointData()
       self.data[point].liquidity_data = liquidity_data
 
    def get_order_data(self, point: int):
+      self.columns = None
       if point not in self.data.keys():
          self.data[point] = PointData()
          self.data[point].order_data = OrderData()
@@ -469,24 +623,36 @@ class PointInfo:
       return self.data[point].order_data
 
    def set_order_data(self, point: int, order_data):
+      self.columns = None
       if point not in self.data.keys():
          self.data[point] = PointData()
       self.data[point].order_data = order_data
 
    def has_active_liquidity( self, point: int, point_delta: int):
       if point % point_delta == 0:
-         point_data = self.get_point_data(point)
+         point_data = self.peek_point_data(point)
          if point_data:
             return point_data.has_active_liquidity()
       return False
 
    def has_active_order(self, point: int, point_delta: int):
       if point % point_delta == 0:
-         point_data = self.get_point_data(point)
+         point_data = self.peek_point_data(point)
          if point_data:
             return point_data.has_active_order()
       return False
 
+   # same as has_active_liquidity, an endpoint is a point where some range starts or ends
+   def is_endpoint(self, point: int, point_delta: int):
+      return self.has_active_liquidity(point, point_delta)
+
+   # columnar snapshot of all points for whole-pool scans, see PointColumns
+   # built once and reused until a point may have changed
+   def get_columns(self):
+      if self.columns is None:
+         self.columns = PointColumns(self)
+      return self.columns
+
    def get_point_type_value(self, point: int, point_delta: int ):
       point_type = 0
       if point % point_delta == 0:
@@ -515,6 +681,7 @@ class PointInfo:
       return (fee_scale_x_128 - fee_scale_lx_128 - fee_scale_gex_128, fee_scale_y_128 - fee_scale_ly_128 - fee_scale_gey_128 )
 
    def update_endpoint( self, endpoint: int, is_left: bool, current_point: int, liquidity_delta: int, max_liquidity_per_point: int, fee_scale_x_128: int, fee_scale_y_128: int):
+      self.columns = None
       point_data = self.data.pop(endpoint, PointData())
       
       liquidity_data = point_data.liquidity_data
@@ -564,6 +731,115 @@ class PointInfo:
    def set_point_stats_data(self, point: int, point_stats_data):
       self.stats_data[point] = point_stats_data
 
+# Copy-on-access overlay of a PointInfo, used by quotes.
+# Every PointData read through the view is copied once into the view's own data,
+# so swap loops can mutate it freely without touching the underlying PointInfo.
+# stats_data of the view starts empty and is never merged back.
+class PointInfoView(PointInfo):
+   def __init__(self, base: PointInfo):
+      self.base = base
+      self.data = {}
+      self.stats_data = {}
+      self.columns = None
+
+   def peek_point_data(self, point: int):
+      if point in self.data:
+         return self.data[point]
+      return self.base.peek_point_data(point)
+
+   def get_point_data(self, point: int):
+      if point in self.data:
+         return self.data[point]
+      base_point_data = self.base.get_point_data(point)
+      if base_point_data is None:
+         return None
+      point_data = PointData()
+      if base_point_data.liquidity_data:
+         point_data.liquidity_data = copy.copy(base_point_data.liquidity_data)
+      if base_point_data.order_data:
+         point_data.order_data = copy.copy(base_point_data.order_data)
+      self.data[point] = point_data
+      return point_data
+
+   def get_point_data_or_default(self, point: int):
+      point_data = self.get_point_data(point)
+      if point_data is None:
+         return PointData()
+      return point_data
+
+   def get_liquidity_data(self, point: int):
+      point_data = self.get_point_data(point)
+      if point_data is None:
+         point_data = PointData()
+         self.data[point] = point_data
+      if point_data.liquidity_data is None:
+         point_data.liquidity_data = LiquidityData()
+      return point_data.liquidity_data
+
+   def get_order_data(self, point: int):
+      point_data = self.get_point_data(point)
+      if point_data is None:
+         point_data = PointData()
+         self.data[point] = point_data
+      if point_data.order_data is None:
+         point_data.order_data = OrderData()
+      return point_data.order_data
+
+   # move the points touched through this view into base, base must be a PointInfoView
+   def commit(self):
+      self.base.columns = None
+      self.base.data.update(self.data)
+      self.data = {}
+
+# Columnar snapshot of a PointInfo: sorted points plus parallel int columns and their prefix sums.
+# Values are u128, so plain lists are used instead of fixed width arrays.
+# Swaps keep mutating PointData through the PointInfo accessors, which drop the snapshot cached by get_columns.
+class PointColumns:
+   def __init__(self, point_info: PointInfo):
+      self.points = sorted(point_info.data.keys())
+      self.liquidity_sum = []
+      self.liquidity_delta = []
+      self.selling_x = []
+      self.selling_y = []
+      for point in self.points:
+         point_data = point_info.data[point]
+         liquidity_data = point_data.liquidity_data
+         order_data = point_data.order_data
+         self.liquidity_sum.append(liquidity_data.liquidity_sum if liquidity_data else 0)
+         self.liquidity_delta.append(liquidity_data.liquidity_delta if liquidity_data else 0)
+         self.selling_x.append(order_data.selling_x if order_data else 0)
+         self.selling_y.append(order_data.selling_y if order_data else 0)
+      # acc_liquidity[i] is the liquidity in [points[i], points[i+1])
+      self.acc_liquidity = list(itertools.accumulate(self.liquidity_delta))
+      # acc_selling_*[i] is the sum of the first i points
+      self.acc_selling_x = [0] + list(itertools.accumulate(self.selling_x))
+      self.acc_selling_y = [0] + list(itertools.accumulate(self.selling_y))
+
+   # liquidity of the range that contains point
+   def liquidity_at(self, point: int):
+      i = bisect.bisect_right(self.points, point) - 1
+      if i < 0:
+         return 0
+      return self.acc_liquidity[i]
+
+   # sum of selling_x of orders on [left_point, right_point)
+   def selling_x_in(self, left_point: int, right_point: int):
+      return self.acc_selling_x[bisect.bisect_left(self.points, right_point)] - self.acc_selling_x[bisect.bisect_left(self.points, left_point)]
+
+   # sum of selling_y of orders on [left_point, right_point)
+   def selling_y_in(self, left_point: int, right_point: int):
+      return self.acc_selling_y[bisect.bisect_left(self.points, right_point)] - self.acc_selling_y[bisect.bisect_left(self.points, left_point)]
+
+   # token x and y locked by liquidity at every endpoint range, [(point, amount_x, amount_y)]
+   def tvl(self, point_delta: int, current_point: int):
+      ret = []
+      for i, point in enumerate(self.points):
+         if self.acc_liquidity[i] > 0:
+            right_point = self.points[i + 1] if i + 1 < len(self.points) else point + point_delta
+            (amount_x, amount_y) = compute_deposit_x_y(self.acc_liquidity[i], point, right_point, current_point)
+            ret.append((point, amount_x, amount_y))
+      return ret
+
 def get_fee_scale_l( endpoint: int, current_point: int, fee_scale_128: int, fee_scale_beyond_128: int ): 
    if (endpoint <= current_point):
       return (fee_scale_beyond_128)
@@ -578,13 +854,32 @@ def get_fee_scale_ge( endpoint: int, current_point: int, fee_scale_128: int, fee
 
 
 class Slot_BitMap:
-   def __init__(self):
+   def __init__(self, use_index: bool = False):
       self.data = {}
+      # optional sorted list of word_idx with a non-zero word, lets nearest slot queries jump over empty words
+      self.word_index = None
+      if use_index:
+         self.enable_index()
+
+   def enable_index(self):
+      # loaded bitmaps may hold zero words, which are never the nearest valued word
+      self.word_index = sorted(k for k, v in self.data.items() if v)
+
+   def disable_index(self):
+      self.word_index = None
 
    def load_slot_bitmap(self, slot_bitmap):
       for key, value in slot_bitmap.items():
          import binascii 
          self.data[int(key)] = int.from_bytes(binascii.a2b_hex(value), 'little', signed = False) # little endian
+      if self.word_index is not None:
+         self.enable_index()
+
+   # same as load_slot_bitmap, from a slotbitmap table of the binary snapshot, see convert_dcl_state
+   def load_slot_columns(self, columns: dict):
+      self.data.update(zip(columns['word'], columns['value']))
+      if self.word_index is not None:
+         self.enable_index()
 
    def dump(self):
       print("----------------dump slot_bitmap-------------------")
@@ -607,7 +902,8 @@ class Slot_BitMap:
             self.set_one(point, point_delta)
 
    def remove(self, point: int):
-      self.data.pop(point, None)
+      if self.data.pop(point, 0) and self.word_index is not None:
+         del self.word_index[bisect.bisect_left(self.word_index, point)]
 
    def set_zero(self,point: int, point_delta: int ):
       if( point % point_delta != 0 ):
@@ -622,6 +918,8 @@ class Slot_BitMap:
       
       if new_val != 0:
          self.data[word_idx] = new_val
+      elif val != 0 and self.word_index is not None:
+         del self.word_index[bisect.bisect_left(self.word_index, word_idx)]
       #print("set_zero: word_idx = ", word_idx, ", data[word_idx] = ",new_val)
 
    def set_one(self,point: int, point_delta: int ):
@@ -638,6 +936,8 @@ class Slot_BitMap:
          self.data[word_idx] = val | (1 << bit_idx)
       else:
          self.data[word_idx] = 1 << bit_idx
+         if self.word_index is not None:
+            bisect.insort(self.word_index, word_idx)
       #print("set_one: point = ", point, ", map_pt = ", map_pt, ", word_idx = ", word_idx, ", data[word_idx] = ", hex(self.data[word_idx]), ", bit_idx = ", bit_idx)
 
    def get_bit(self, point: int, point_delta: int ):
@@ -669,9 +969,7 @@ class Slot_BitMap:
    # return None if no valued slot found at the right of stop_slot (including stop_slot)
    # pub fn get_nearest_left_valued_slot( &self, point: i32, point_delta: i32, stop_slot: i32 ) -> Option<i32>
    def get_nearest_left_valued_slot(self, point: int, point_delta: int, stop_slot: int):
-      slot = point // point_delta
-      if ( point < 0 and point % point_delta != 0 ):
-         slot -= 1 # round towards negative infinity
+      slot = point // point_delta # already rounds towards negative infinity
       word_idx = slot >> 8
       bit_idx = slot % 256
       #print("slot =",slot, ", word_idx =",word_idx, ", bit_idx =",bit_idx)
@@ -687,6 +985,20 @@ class Slot_BitMap:
       #print("slot_word = ",slot_word, ", base_slot = ",base_slot,", stop_slot - 256 = ",stop_slot - 256)
       
       ret = None
+
+      if self.word_index is not None:
+         if base_slot > (stop_slot - 256) and slot_word == 0:
+            # jump to the nearest non-zero word on the left
+            i = bisect.bisect_left(self.word_index, word_idx)
+            if i == 0:
+               return None
+            base_slot = self.word_index[i - 1] << 8
+            slot_word = self.data[self.word_index[i - 1]]
+         if base_slot > (stop_slot - 256):
+            target_slot = base_slot + idx_of_most_left_set_bit(slot_word)
+            if target_slot >= stop_slot:
+               ret = target_slot * point_delta
+         return ret
      
       while ( base_slot > (stop_slot - 256) ):
          a = idx_of_most_left_set_bit(slot_word)
@@ -727,6 +1039,20 @@ class Slot_BitMap:
       
       ret = None
 
+      if self.word_index is not None:
+         if base_slot <= stop_slot and slot_word == 0:
+            # jump to the nearest non-zero word on the right
+            i = bisect.bisect_right(self.word_index, word_idx)
+            if i == len(self.word_index):
+               return None
+            base_slot = self.word_index[i] << 8
+            slot_word = self.data[self.word_index[i]]
+         if base_slot <= stop_slot:
+            target_slot = base_slot + idx_of_most_right_set_bit(slot_word)
+            if target_slot <= stop_slot:
+               ret = target_slot * point_delta
+         return ret
+
       while ( base_slot <= stop_slot ):
          a = idx_of_most_right_set_bit(slot_word)
          if a != None:
@@ -887,6 +1213,78 @@ class Pool:
       print("fee_scale_y_128:",self.fee_scale_y_128)
       print("----------------dump pool: "+self.parent_name+" completed-------------------")
    
+   # Lightweight copy of this pool for quoting.
+   # Scalar state is copied, point_info is wrapped in a PointInfoView and slot_bitmap is shared,
+   # so swapping on the returned pool with is_quote = True leaves this pool untouched.
+   # @return Pool
+   def get_quote_view(self):
+      view = copy.copy(self)
+      view.point_info = PointInfoView(self.point_info)
+      return view
+
+   # Cumulative price impact curve of one swap direction, one entry per swap loop iteration,
+   # i.e. each time the swap reaches a liquidity endpoint or a limit order point.
+   # Entries are flattened as [input, output, end_point, input, output, end_point, ...],
+   # starting from (0, 0, current_point), so any trade size can be interpolated by bisecting input.
+   # @param protocol_fee_rate
+   # @param x_to_y: True to swap token X for token Y
+   # @return flat list of int
+   def get_price_impact_curve(self, protocol_fee_rate: int, x_to_y: bool):
+      view = self.get_quote_view()
+      # larger than any u128 input, the swap only stops at the boundary
+      amount = 2**128
+      curve = [0, 0, view.current_point]
+      consumed = 0
+      acquired = 0
+      is_finished = None
+      while is_finished is None:
+         if x_to_y:
+            (cost, out_amount, is_finished, _, _) = view.internal_x_swap_y(self.fee, protocol_fee_rate, amount - consumed, -799999, True, 1)
+         else:
+            (cost, out_amount, is_finished, _, _) = view.internal_y_swap_x(self.fee, protocol_fee_rate, amount - consumed, 799999, True, 1)
+         if cost > 0 or out_amount > 0 or view.current_point != curve[-1]:
+            consumed += cost
+            acquired += out_amount
+            curve.extend((consumed, acquired, view.current_point))
+      return curve
+
+   # Quote many input amounts in one pass over the pool, results equal separate quotes on fresh views.
+   # Amounts are filled in ascending order by stepping a shared view one swap loop iteration at a time.
+   # An iteration that does not finish consumes and gains the same whatever the remaining amount,
+   # so only the iteration in which an amount finishes is swapped on a throwaway copy.
+   # @param pool_fee
+   # @param protocol_fee_rate
+   # @param amounts: list of input amounts
+   # @param x_to_y: True to swap token X for token Y
+   # @return list of (out_amount, is_finished) in the order of amounts
+   def quote_many(self, pool_fee: int, protocol_fee_rate: int, amounts: list, x_to_y: bool):
+      results = [(0, False)] * len(amounts)
+      view = self.get_quote_view()
+      consumed = 0
+      acquired = 0
+      exhausted = False
+      for idx in sorted(range(len(amounts)), key=lambda i: amounts[i]):
+         while not exhausted:
+            step = view.get_quote_view()
+            if x_to_y:
+               (cost, out_amount, is_finished, _, _) = step.internal_x_swap_y(pool_fee, protocol_fee_rate, amounts[idx] - consumed, -799999, True, 1)
+            else:
+               (cost, out_amount, is_finished, _, _) = step.internal_y_swap_x(pool_fee, protocol_fee_rate, amounts[idx] - consumed, 799999, True, 1)
+            if is_finished:
+               results[idx] = (acquired + out_amount, True)
+               break
+            # the iteration is shared by every larger amount, keep it
+            step.point_info.commit()
+            step.point_info = view.point_info
+            view = step
+            consumed += cost
+            acquired += out_amount
+            # False means the swap loop ended without finishing
+            exhausted = is_finished == False
+         if exhausted:
+            results[idx] = (acquired, False)
+      return results
+
    def get_liquidity(self, lpt_id):
       pass
 
@@ -1225,9 +1623,10 @@ class Pool:
    # @param input_amount: amount of token X
    # @param low_boundary_point: swap won't pass this point
    # @param is_quote: whether is it called by a quote interface
+   # @param max_steps: stop after this many loop iterations, None for no limit; is_finished is None if stopped so
    # @return (consumed_x, gained_y, is_finished)
    # internal_x_swap_y(&mut self, pool_fee: u32, protocol_fee_rate: u32, input_amount: u128, low_boundary_point: i32, is_quote: bool) -> (u128, u128, bool, u128, u128)
-   def internal_x_swap_y(self, pool_fee: int, protocol_fee_rate: int, input_amount: int, low_boundary_point: int, is_quote: bool):
+   def internal_x_swap_y(self, pool_fee: int, protocol_fee_rate: int, input_amount: int, low_boundary_point: int, is_quote: bool, max_steps: int = None):
       boundary_point = max(low_boundary_point, LEFT_MOST_POINT)
       amount = input_amount
       amount_x = 0
@@ -1235,17 +1634,21 @@ class Pool:
       is_finished = False
       total_fee = 0
       protocol_fee = 0
+      steps = 0
       #print("internal_x_swap_y, current_point =",self.current_point)
       while (boundary_point <= self.current_point and is_finished == False):
+         if steps == max_steps:
+            is_finished = None
+            break
+         steps += 1
          current_order_or_endpt = self.point_info.get_point_type_value(self.current_point, self.point_delta)
          # step1: process possible limit order on current point
          #print("current_order_or_endpt = ",current_order_or_endpt)
          if (current_order_or_endpt & 2) > 0:
             # process limit order
-            point_data = None
             order_data = None
-            if self.current_point in self.point_info.data.keys():
-               point_data = self.point_info.data[self.current_point]
+            point_data = self.point_info.get_point_data(self.current_point)
+            if point_data:
                order_data = point_data.order_data
             
             #self.point_info.dump()
@@ -1416,9 +1819,10 @@ class Pool:
    # @param input_amount: amount of token Y
    # @param hight_boundary_point
    # @param is_quote: whether the quote function is calling
+   # @param max_steps: stop after this many loop iterations, None for no limit; is_finished is None if stopped so
    # @return (consumed_y, gained_x, is_finished)
    # internal_y_swap_x(&mut self, pool_fee: u32, protocol_fee_rate: u32, input_amount: u128, hight_boundary_point: i32, is_quote: bool) -> (u128, u128, bool, u128, u128)
-   def internal_y_swap_x(self, pool_fee: int, protocol_fee_rate: int, input_amount: int, hight_boundary_point: int, is_quote: bool):
+   def internal_y_swap_x(self, pool_fee: int, protocol_fee_rate: int, input_amount: int, hight_boundary_point: int, is_quote: bool, max_steps: int = None):
       boundary_point = min(hight_boundary_point, RIGHT_MOST_POINT)
       amount = input_amount
       amount_x = 0
@@ -1426,15 +1830,19 @@ class Pool:
       is_finished = False
       total_fee = 0
       protocol_fee = 0
+      steps = 0
       current_order_or_endpt  = self.point_info.get_point_type_value(self.current_point, self.point_delta)
       #print("internal_y_swap_x, current_point =",self.current_point)
       while self.current_point < boundary_point and is_finished == False:
+         if steps == max_steps:
+            is_finished = None
+            break
+         steps += 1
          if (current_order_or_endpt & 2) > 0:
             # process limit order
-            point_data = None
             order_data = None
-            if self.current_point in self.point_info.data.keys():
-               point_data = self.point_info.data[self.current_point]
+            point_data = self.point_info.get_point_data(self.current_point)
+            if point_data:
                order_data = point_data.order_data
             
             (process_ret0,process_ret1,process_ret2,process_ret3,process_ret4) = self.process_limit_order_x(pool_fee, protocol_fee_rate, order_data, amount)
@@ -1555,7 +1963,7 @@ class Pool:
             self.current_point = x2y_range_desire_result.final_pt
             self.sqrt_price_96 = x2y_range_desire_result.sqrt_final_price_96
             self.liquidity_x = x2y_range_desire_result.liquidity_x
-            return (x2y_range_desire_result.finished, (x2y_range_desire_result.cost_x + fee_amount), x2y_range_desire_result.acquire_y)
+            return (x2y_range_desire_result.finished, (x2y_range_desire_result.cost_x + fee_amount), x2y_range_desire_result.acquire_y, fee_amount, charged_fee_amount)
          else:
             # swap hasn't completed but current range has no liquidity_y
             if self.current_point != left_pt:
@@ -1565,7 +1973,7 @@ class Pool:
             return (False, 0, 0, 0, 0)
       else:
          # swap has already completed
-         (True, 0, 0, 0, 0)
+         return (True, 0, 0, 0, 0)
 
    # Process x_swap_y by desire_y in range
    # @param protocol_fee_rate
@@ -1577,7 +1985,7 @@ class Pool:
    def internal_x_swap_y_desire_y(self, pool_fee: int, protocol_fee_rate: int, desire_y: int, low_boundary_point: int, is_quote: bool):
       if(desire_y <= 0):
          print("E205_INVALID_DESIRE_AMOUNT")
-         return (0,0,False)
+         return (0, 0, False, 0, 0)
       
       boundary_point = max(low_boundary_point, LEFT_MOST_POINT)
       is_finished = False
@@ -1593,17 +2001,17 @@ class Pool:
          # step1: process possible limit order on current point
          if (current_order_or_endpt & 2) > 0:
             # process limit order
-            point_data = None
             order_data = None
-            if self.current_point in self.point_info.data.keys():
-               point_data = self.point_info.data[self.current_point]
+            point_data = self.point_info.get_point_data(self.current_point)
+            if point_data:
                order_data = point_data.order_data
             
             (process_ret0, process_ret1, process_ret2, process_ret3, process_ret4) = self.process_limit_order_y_desire_y(pool_fee, protocol_fee_rate, order_data, desire_y)
             is_finished = process_ret0
-            desire_y = 0
             if desire_y > process_ret2:
                desire_y = desire_y - process_ret2
+            else:
+               desire_y = 0
             
             (amount_x, amount_y, total_fee, protocol_fee) = (amount_x + process_ret1, amount_y + process_ret2, total_fee+process_ret3, protocol_fee+process_ret4)
 
@@ -1668,9 +2076,9 @@ class Pool:
                   next_pt = point
          
          # step 3b: do range swap according to the left point located in step 3a
-         (process_ret0, process_ret1, process_ret2, process_ret3, process_ret4) = self.process_liquidity_y_desire_y(pool_fee, protocol_fee_rate, amount, next_pt)
+         (process_ret0, process_ret1, process_ret2, process_ret3, process_ret4) = self.process_liquidity_y_desire_y(pool_fee, protocol_fee_rate, desire_y, next_pt)
          is_finished = process_ret0
-         (amount, amount_x, amount_y, total_fee, protocol_fee) = (amount-process_ret1, amount_x+process_ret1, amount_y+process_ret2, total_fee + process_ret3, protocol_fee + process_ret4)
+         (desire_y, amount_x, amount_y, total_fee, protocol_fee) = (desire_y - min(desire_y, process_ret2), amount_x+process_ret1, amount_y+process_ret2, total_fee + process_ret3, protocol_fee + process_ret4)
          
          # check the swap is completed or not
          if is_finished or self.current_point <= boundary_point:
@@ -1759,7 +2167,7 @@ class Pool:
    def internal_y_swap_x_desire_x(self, pool_fee: int, protocol_fee_rate: int, desire_x: int, high_boundary_point: int, is_quote: bool):
       if(desire_x <= 0):
          print("E205_INVALID_DESIRE_AMOUNT")
-         return (0,0,False)
+         return (0, 0, False, 0, 0)
       
       boundary_point = min(high_boundary_point, RIGHT_MOST_POINT)
       is_finished = False
@@ -1773,17 +2181,17 @@ class Pool:
       while self.current_point < boundary_point and is_finished == False:
          if current_order_or_endpt & 2 > 0:
             # process limit order
-            point_data = None
             order_data = None
-            if self.current_point in self.point_info.data.keys():
-               point_data = self.point_info.data[self.current_point]
+            point_data = self.point_info.get_point_data(self.current_point)
+            if point_data:
                order_data = point_data.order_data
             
             process_ret0, process_ret1, process_ret2, process_ret3, process_ret4 = self.process_limit_order_x_desire_x(pool_fee, protocol_fee_rate, order_data, desire_x)
             is_finished = process_ret0
-            desire_x = 0
             if desire_x > process_ret2:
                desire_x = desire_x - process_ret2
+            else:
+               desire_x = 0
             (amount_x, amount_y, total_fee, protocol_fee) = (amount_x + process_ret2, amount_y + process_ret1, total_fee+process_ret3, protocol_fee+process_ret4)
 
             # stats for limit order
@@ -2392,7 +2800,7 @@ class Pool:
 
          ############################################################################         
          # update point_stats_data
-         current_endpoint = y2x_range_comp_result.loc_pt // self.point_delta         
+         current_endpoint = y2x_range_comp_desire_result.loc_pt // self.point_delta         
 
          stats_data = self.point_info.get_point_stats_data_or_default(current_endpoint*self.point_delta)
          
@@ -2445,7 +2853,7 @@ class Pool:
          point_data.order_data = order_data
          if False == point_data.has_active_order() and False == point_data.has_active_liquidity():
             self.slot_bitmap.set_zero(self.current_point, self.point_delta)
-         self.point_info.data[self.current_point] = point_data
+         self.point_info.set_point_data(self.current_point, point_data)
 
 
    # pub fn get_pool_fee_by_user(&self, vip_info: &Option<HashMap<PoolId, u32>>) -> u32
@@ -2627,12 +3035,21 @@ pub next_approval_id_by_id: LookupMap<LptId, u64>,
 pub user_orders: LookupMap<OrderId, UserOrder>,   
 '''
 MARKET_QUERY_SLOT_LIMIT = 150000
+# fields of dcl_user_liquidities.json and dcl_user_orders.json entries that load_dcl_state reads
+USER_LIQUIDITY_FIELDS = ('LptId', 'owner_id', 'pool_id', 'left_point', 'right_point', 'last_fee_scale_x_128', 'last_fee_scale_y_128',
+                         'amount', 'mft_id', 'v_liquidity', 'unclaimed_fee_x', 'unclaimed_fee_y')
+USER_ORDER_FIELDS = ('order_id', 'owner_id', 'pool_id', 'point', 'sell_token', 'buy_token', 'original_deposit_amount', 'swap_earn_amount',
+                     'original_amount', 'cancel_amount', 'created_at', 'last_acc_earn', 'remain_amount', 'bought_amount', 'unclaimed_amount')
+
 class Dcl:
    def __init__(self, protocol_fee_rate = 2000, name = ""):
       self.name = name
       self.protocol_fee_rate = protocol_fee_rate
       self.fee_tier = {'100': 1, '400': 8, '2000': 40, '10000': 200}
       self.pools = {} # Pool list
+      self.lazy_pools = {} # pool_id -> dcl_pool.json entry of the pools in snapshot not decoded yet, see load_dcl_snapshot
+      self.snapshot = None
+      self.slot_index = False
       self.user_liquidities = {} # user liquidities. LookupMap<LptId, VUserLiquidity>
       self.user_orders = {} # UserOrder. LookupMap<OrderId, VUserOrder>
       self.users = {} # User. Will register user automatically
@@ -2680,53 +3097,135 @@ class Dcl:
       self.latest_liquidity_id = self.dcl_root.get('latest_liquidity_id',0)
       self.latest_order_id = self.dcl_root.get('latest_order_id',0)
       self.load_pool()
+      # decoded into point_info of each pool, the raw json is no longer needed
+      self.dcl_pointinfo = None
       self.load_user_liquidities()
       self.load_user_limit_orders()
       self.load_vip_users()
       
+   # same state as load_dcl_state, from the binary snapshot written by convert_dcl_state
+   # @param lazy: map the file and decode each pool on its first get_pool, users are decoded right away
+   def load_dcl_snapshot(self, filepath = './dcl_state.snap', lazy: bool = False):
+      # the objects are built in bulk and hold no cycles, so the collector is paused meanwhile
+      gc_enabled = gc.isenabled()
+      gc.disable()
+      try:
+         snapshot = SnapshotReader(filepath, use_mmap = lazy)
+         self.dcl_root = snapshot.get_json("root")
+         self.dcl_pool = snapshot.get_json("pool")
+         self.latest_liquidity_id = self.dcl_root.get('latest_liquidity_id',0)
+         self.latest_order_id = self.dcl_root.get('latest_order_id',0)
+         if lazy:
+            self.snapshot = snapshot
+            self.lazy_pools = {pool_data['pool_id']: pool_data for pool_data in self.dcl_pool.values()}
+         else:
+            for pool_data in self.dcl_pool.values():
+               self.pools[pool_data['pool_id']] = self.decode_snapshot_pool(snapshot, pool_data)
+
+         # mft_id and v_liquidity are optional
+         columns = snapshot.get_table("user_liquidities")
+         user_liquidities = [UserLiquidity() for _ in columns['key']]
+         for k in USER_LIQUIDITY_FIELDS:
+            set_column(user_liquidities, k, columns[k])
+         self.user_liquidities.update(zip(columns['key'], user_liquidities))
+
+         columns = snapshot.get_table("user_orders")
+         user_orders = [UserOrder() for _ in columns['key']]
+         for k in USER_ORDER_FIELDS:
+            set_column(user_orders, k, columns[k])
+         self.user_orders.update(zip(columns['key'], user_orders))
+
+         self.vip_users = snapshot.get_json("vip_users")
+      finally:
+         if gc_enabled:
+            gc.enable()
+
+
+   def decode_snapshot_pool(self, snapshot, pool_data: dict):
+      pool = self.build_pool(pool_data)
+      pool.point_info.load_point_columns(snapshot.get_table("pointinfo:" + pool_data['pool_id']))
+      pool.slot_bitmap.load_slot_columns(snapshot.get_table("slotbitmap:" + pool_data['pool_id']))
+      
+      print("load pool: ", pool_data['pool_id'], ", current_point =", pool_data['current_point'])
+      return pool
+
+   # decode a pool left in the snapshot by load_dcl_snapshot(lazy = True)
+   def load_lazy_pool(self, pool_id: str):
+      pool = self.decode_snapshot_pool(self.snapshot, self.lazy_pools.pop(pool_id))
+      pool.parent_name = self.name
+      if self.slot_index:
+         pool.slot_bitmap.enable_index()
+      self.pools[pool_id] = pool
+      return pool
+
+   def load_lazy_pools(self):
+      for pool_id in list(self.lazy_pools.keys()):
+         self.load_lazy_pool(pool_id)
+
+   # every pool, where the pools not decoded yet are decoded for the caller only and stay in the snapshot
+   # @return iterator of (pool_id, pool)
+   def iter_pools(self):
+      for pool_id, pool in list(self.pools.items()):
+         yield (pool_id, pool)
+      for pool_id, pool_data in list(self.lazy_pools.items()):
+         yield (pool_id, self.decode_snapshot_pool(self.snapshot, pool_data))
+
+   def get_point_deltas(self):
+      return [pool.point_delta for pool in self.pools.values()] + [pool_data['point_delta'] for pool_data in self.lazy_pools.values()]
+
+   # index the slot bitmap of every pool, including the pools decoded later
+   def enable_slot_index(self):
+      self.slot_index = True
+      for pool in self.pools.values():
+         pool.slot_bitmap.enable_index()
 
    def load_pool(self):
       for pool_data in self.dcl_pool.values():
-         pool = Pool()
-         
-         pool.pool_id = pool_data['pool_id']
-         pool.token_x = pool_data['token_x']
-         pool.token_y = pool_data['token_y']
-         pool.fee = pool_data['fee']
-         pool.point_delta = pool_data['point_delta']
-         pool.current_point = pool_data['current_point']
-         pool.sqrt_price_96 = pool_data['sqrt_price_96']
-         pool.liquidity = pool_data['liquidity']
-         pool.liquidity_x = pool_data['liquidity_x']
-         pool.max_liquidity_per_point = pool_data['max_liquidity_per_point']
-         pool.fee_scale_x_128 = pool_data['fee_scale_x_128']
-         pool.fee_scale_y_128 = pool_data['fee_scale_y_128']
-         pool.total_fee_x_charged = pool_data['total_fee_x_charged']
-         pool.total_fee_y_charged = pool_data['total_fee_y_charged']
-         pool.volume_x_in = pool_data['volume_x_in']
-         pool.volume_y_in = pool_data['volume_y_in']
-         pool.volume_x_out = pool_data['volume_x_out']
-         pool.volume_y_out = pool_data['volume_y_out']
-         pool.total_liquidity = pool_data['total_liquidity']
-         pool.total_order_x = pool_data['total_order_x']
-         pool.total_order_y = pool_data['total_order_y']
-         pool.total_x = pool_data['total_x']
-         pool.total_y = pool_data['total_y']
-         pool.RunningState = pool_data['RunningState']
+         pool = self.build_pool(pool_data)
          pool.point_info = PointInfo()
          pool.point_info.load_point_info(self.dcl_pointinfo[pool_data['pool_id']])
          pool.slot_bitmap = Slot_BitMap()
          pool.slot_bitmap.load_slot_bitmap(self.dcl_slotbitmap[pool_data['pool_id']])
          #pool.slot_bitmap.dump()
-         token_x_meta = get_ft_metadata(pool.token_x)
-         token_y_meta = get_ft_metadata(pool.token_y)
-         pool.token_x_decimal = token_x_meta['decimals']
-         pool.token_y_decimal = token_y_meta['decimals']
          
          print("load pool: ", pool_data['pool_id'], ", current_point =", pool_data['current_point'])
 
          self.pools[pool_data['pool_id']] = pool
 
+   # pool from its dcl_pool.json entry, point_info and slot_bitmap are left empty
+   def build_pool(self, pool_data: dict):
+      pool = Pool()
+      
+      pool.pool_id = pool_data['pool_id']
+      pool.token_x = pool_data['token_x']
+      pool.token_y = pool_data['token_y']
+      pool.fee = pool_data['fee']
+      pool.point_delta = pool_data['point_delta']
+      pool.current_point = pool_data['current_point']
+      pool.sqrt_price_96 = pool_data['sqrt_price_96']
+      pool.liquidity = pool_data['liquidity']
+      pool.liquidity_x = pool_data['liquidity_x']
+      pool.max_liquidity_per_point = pool_data['max_liquidity_per_point']
+      pool.fee_scale_x_128 = pool_data['fee_scale_x_128']
+      pool.fee_scale_y_128 = pool_data['fee_scale_y_128']
+      pool.total_fee_x_charged = pool_data['total_fee_x_charged']
+      pool.total_fee_y_charged = pool_data['total_fee_y_charged']
+      pool.volume_x_in = pool_data['volume_x_in']
+      pool.volume_y_in = pool_data['volume_y_in']
+      pool.volume_x_out = pool_data['volume_x_out']
+      pool.volume_y_out = pool_data['volume_y_out']
+      pool.total_liquidity = pool_data['total_liquidity']
+      pool.total_order_x = pool_data['total_order_x']
+      pool.total_order_y = pool_data['total_order_y']
+      pool.total_x = pool_data['total_x']
+      pool.total_y = pool_data['total_y']
+      pool.RunningState = pool_data['RunningState']
+      token_x_meta = get_cached_ft_metadata(pool.token_x)
+      token_y_meta = get_cached_ft_metadata(pool.token_y)
+      pool.token_x_decimal = token_x_meta['decimals']
+      pool.token_y_decimal = token_y_meta['decimals']
+      return pool
+
    def load_user_liquidities(self):
       for user_liquidity in self.dcl_user_liquidities.values():
          for lptid, liquidity in user_liquidity.items():
@@ -2778,22 +3277,43 @@ class Dcl:
       pass
 
 
-   def dump_pools_stats_data(self):
+   # @param run_length: write ./dcl_endpoint_stats_rle.json, where each pool is {"point_delta", "ranges": [[left, right, stats], ...]}
+   #                     and consecutive points with the same stats share one range, see utils.EndpointStatsRuns for reading
+   def dump_pools_stats_data(self, run_length: bool = False):
       stats_result = {}
 
-      for pool_id in self.pools.keys():
-         current_point = self.pools[pool_id].current_point
-         point_delta = self.pools[pool_id].point_delta
-         pool_fee = self.pools[pool_id].fee
-         token_x_decimal = self.pools[pool_id].token_x_decimal
-         token_y_decimal = self.pools[pool_id].token_y_decimal
-         stats_result[pool_id] = self.pools[pool_id].point_info.dump_stats_data(current_point, point_delta, pool_fee, self.protocol_fee_rate, token_x_decimal, token_y_decimal)
+      for pool_id, pool in self.iter_pools():
+         current_point = pool.current_point
+         point_delta = pool.point_delta
+         pool_fee = pool.fee
+         token_x_decimal = pool.token_x_decimal
+         token_y_decimal = pool.token_y_decimal
+         stats = pool.point_info.dump_stats_data(current_point, point_delta, pool_fee, self.protocol_fee_rate, token_x_decimal, token_y_decimal, not run_length)
+         if run_length:
+            stats_result[pool_id] = {"point_delta": point_delta, "ranges": encode_stats_runs(stats, point_delta)}
+         else:
+            stats_result[pool_id] = stats
       
       filepath = './dcl_endpoint_stats.json'
+      if run_length:
+         filepath = './dcl_endpoint_stats_rle.json'
       with open(filepath, mode='w', encoding="utf-8") as f:
          json.dump(stats_result, f, sort_keys = True)
          print("%s saved" % filepath)
 
+   # Save price impact curves of both directions of every pool, see Pool.get_price_impact_curve
+   def dump_price_impact_curves(self, filepath = './dcl_price_impact_curves.json'):
+      curves = {}
+      for pool_id, pool in self.iter_pools():
+         curves[pool_id] = {
+            "x_to_y": pool.get_price_impact_curve(self.protocol_fee_rate, True),
+            "y_to_x": pool.get_price_impact_curve(self.protocol_fee_rate, False),
+         }
+
+      with open(filepath, mode='w', encoding="utf-8") as f:
+         json.dump(curves, f, sort_keys = True, separators = (',', ':'))
+         print("%s saved" % filepath)
+
    def pause_contract(self):
       self.state = PAUSED
 
@@ -2834,10 +3354,13 @@ class Dcl:
    def get_pool(self, pool_id: str):
       if pool_id in self.pools.keys():
          return self.pools[pool_id]
+      elif pool_id in self.lazy_pools:
+         return self.load_lazy_pool(pool_id)
       else:
          return None
 
    def set_pool(self, pool_id: str, pool):
+      self.lazy_pools.pop(pool_id, None)
       self.pools[pool_id] = pool
 
    def get_user_order(self, order_id: str):
@@ -3170,6 +3693,8 @@ class Dcl:
          pool_record.append(pool.token_x+"|"+pool.token_y)
 
          pool_fee = pool.get_pool_fee_by_user(vip_info)
+         # swap on a view, the loaded state must stay untouched
+         pool = pool.get_quote_view()
          
          is_finished = None
          if next_input_token_or_last_output_token == pool.token_x:
@@ -3178,7 +3703,7 @@ class Dcl:
             next_input_amount_or_actual_output = out_amount
          elif next_input_token_or_last_output_token == pool.token_y:
             (_, out_amount, is_finished, _, _) = pool.internal_y_swap_x(pool_fee, protocol_fee_rate, next_input_amount_or_actual_output, 799999, True)
-            next_input_token_or_last_output_token = pool.token_x.clone()
+            next_input_token_or_last_output_token = pool.token_x
             next_input_amount_or_actual_output = out_amount
          else:
             print("quote: quote_failed4")
@@ -3194,6 +3719,63 @@ class Dcl:
       
       return { "amount": next_input_amount_or_actual_output, "tag": tag }
 
+   # Batch version of quote, each hop walks its pool once for all amounts
+   # @param pool_ids: all pools participating in swap
+   # @param input_token: the swap-in token, must be in pool_ids[0].tokens
+   # @param output_token: the swap-out token, must be in pool_ids[-1].tokens
+   # @param amounts: list of swap-in token amounts
+   # @param account_id: optional, for vip fee
+   # @return list of estimated output token amounts in the order of amounts, 0 where quote fails
+   def quote_many(self, pool_ids, input_token, output_token, amounts, account_id = ""):
+      quote_failed = [0] * len(amounts)
+      if self.state == PAUSED:
+         return quote_failed
+
+      pool_record = []
+      protocol_fee_rate = self.protocol_fee_rate
+
+      vip_info = self.vip_users.get(account_id,{})
+
+      next_input_token_or_last_output_token = input_token
+      next_input_amounts = list(amounts)
+      quoted = [True] * len(amounts)
+
+      for pool_id in pool_ids:
+         pool = self.get_pool(pool_id)
+         if pool is None:
+            print("quote_many: quote_failed1")
+            return quote_failed
+
+         if pool.state == PAUSED:
+            print("quote_many: quote_failed2")
+            return quote_failed
+         if pool.token_x+"|"+pool.token_y in pool_record:
+            print("quote_many: quote_failed3")
+            return quote_failed
+         pool_record.append(pool.token_x+"|"+pool.token_y)
+
+         pool_fee = pool.get_pool_fee_by_user(vip_info)
+
+         if next_input_token_or_last_output_token == pool.token_x:
+            results = pool.quote_many(pool_fee, protocol_fee_rate, next_input_amounts, True)
+            next_input_token_or_last_output_token = pool.token_y
+         elif next_input_token_or_last_output_token == pool.token_y:
+            results = pool.quote_many(pool_fee, protocol_fee_rate, next_input_amounts, False)
+            next_input_token_or_last_output_token = pool.token_x
+         else:
+            print("quote_many: quote_failed4")
+            return quote_failed
+
+         for i, (out_amount, is_finished) in enumerate(results):
+            next_input_amounts[i] = out_amount
+            quoted[i] = quoted[i] and is_finished
+
+      if output_token != next_input_token_or_last_output_token:
+         print("quote_many: quote_failed6")
+         return quote_failed
+
+      return [amount if ok else 0 for (amount, ok) in zip(next_input_amounts, quoted)]
+
    # @param pool_ids: all pools participating in swap
    # @param input_token: the swap-in token, must be in pool_ids[-1].tokens
    # @param output_token: the swap-out token, must be in pool_ids[0].tokens
@@ -3223,14 +3805,18 @@ class Dcl:
             return quote_failed
          pool_record.append(pool.token_x+"|"+pool.token_y)
 
+         pool_fee = pool.fee
+         # swap on a view, the loaded state must stay untouched
+         pool = pool.get_quote_view()
+
          is_finished = None
 
          if next_desire_token == pool.token_x:
-            (need_amount, _, is_finished) = pool.internal_y_swap_x_desire_x(protocol_fee_rate, next_desire_amount, 800001, True)
+            (need_amount, _, is_finished, _, _) = pool.internal_y_swap_x_desire_x(pool_fee, protocol_fee_rate, next_desire_amount, 800001, True)
             next_desire_token = pool.token_y
             next_desire_amount = need_amount
          elif next_desire_token == pool.token_y:
-            (need_amount, _, is_finished) = pool.internal_x_swap_y_desire_y(protocol_fee_rate, next_desire_amount, -800001, True)
+            (need_amount, _, is_finished, _, _) = pool.internal_x_swap_y_desire_y(pool_fee, protocol_fee_rate, next_desire_amount, -800001, True)
             next_desire_token = pool.token_x
             next_desire_amount = need_amount
          else:
@@ -3550,13 +4136,13 @@ class Dcl:
    #pub fn get_marketdepth(self, pool_id: PoolId, depth: u8 ) -> MarketDepth
    def get_marketdepth(self, pool_id: str, depth: int ):
       pool = self.get_pool(pool_id)
-      left_slot_boundary = max(LEFT_MOST_POINT / pool.point_delta, pool.current_point / pool.point_delta - MARKET_QUERY_SLOT_LIMIT)
-      right_slot_boundary = min(RIGHT_MOST_POINT / pool.point_delta, pool.current_point / pool.point_delta + MARKET_QUERY_SLOT_LIMIT)
+      left_slot_boundary = max(LEFT_MOST_POINT // pool.point_delta, pool.current_point // pool.point_delta - MARKET_QUERY_SLOT_LIMIT)
+      right_slot_boundary = min(RIGHT_MOST_POINT // pool.point_delta, pool.current_point // pool.point_delta + MARKET_QUERY_SLOT_LIMIT)
       liquidities = {}
       orders = {}
 
       if pool.point_info.has_active_order(pool.current_point, pool.point_delta):
-         order_data = pool.point_info.get_order_data(pool.current_point)
+         order_data = pool.point_info.peek_point_data(pool.current_point).order_data
          
          point_order_info = PointOrderInfo()
          point_order_info.point = pool.current_point
@@ -3584,7 +4170,7 @@ class Dcl:
                
                range_left_point = range_right_point
                range_info_count -= 1
-               liquidity_data = pool.point_info.get_liquidity_data(range_right_point)
+               liquidity_data = pool.point_info.peek_point_data(range_right_point).liquidity_data
                if liquidity_data.liquidity_delta > 0:
                   current_liquidity += liquidity_data.liquidity_delta
                else:
@@ -3592,7 +4178,7 @@ class Dcl:
 
 
             if pool.point_info.has_active_order(range_right_point, pool.point_delta) and order_count != 0:
-               order_data = pool.point_info.get_order_data(range_right_point)
+               order_data = pool.point_info.peek_point_data(range_right_point).order_data
 
                point_order_info = PointOrderInfo()
                point_order_info.point = range_right_point
@@ -3616,7 +4202,7 @@ class Dcl:
       current_liquidity = pool.liquidity
       
       if pool.point_info.is_endpoint(pool.current_point, pool.point_delta):
-         liquidity_data = pool.point_info.get_liquidity_data(pool.current_point)
+         liquidity_data = pool.point_info.peek_point_data(pool.current_point).liquidity_data
          if liquidity_data.liquidity_delta > 0:
             current_liquidity = pool.liquidity - liquidity_data.liquidity_delta
          else:
@@ -3635,7 +4221,7 @@ class Dcl:
 
                range_right_point = range_left_point
                range_info_count -= 1
-               liquidity_data = pool.point_info.get_liquidity_data(range_left_point)
+               liquidity_data = pool.point_info.peek_point_data(range_left_point).liquidity_data
                if liquidity_data.liquidity_delta > 0:
                   current_liquidity -= liquidity_data.liquidity_delta
                else:
@@ -3643,7 +4229,7 @@ class Dcl:
 
 
             if pool.point_info.has_active_order(range_left_point, pool.point_delta) and order_count != 0:
-               order_data = pool.point_info.get_order_data(range_left_point)
+               order_data = pool.point_info.peek_point_data(range_left_point).order_data
                
                point_order_info = PointOrderInfo()
                point_order_info.point = range_left_point
@@ -3665,6 +4251,7 @@ class Dcl:
       market_depth.amount_l_x = pool.liquidity_x
       market_depth.liquidities = liquidities
       market_depth.orders = orders
+      return market_depth
 
    # Swap to given point and place order
    # @param user_id
@@ -4111,19 +4698,10 @@ class Dcl:
       #'''
 
       print("-------------pointinfo--------------")
-      total_selling_x = 0
-      total_selling_y = 0
-
       #pool.point_info.dump()
-      for point, point_data in pool.point_info.data.items():
-         #print("point = ",point,", order_data =",point_data.order_data)
-         if point_data and point_data.order_data:
-            if point >= pool.current_point:
-               total_selling_x += point_data.order_data.selling_x
-               #print(point,total_selling_x)
-            if point <= pool.current_point:
-               total_selling_y += point_data.order_data.selling_y
-               #print(point,total_selling_y)
+      columns = pool.point_info.get_columns()
+      total_selling_x = columns.selling_x_in(pool.current_point, RIGHT_MOST_POINT + 1)
+      total_selling_y = columns.selling_y_in(LEFT_MOST_POINT, pool.current_point + 1)
       print("total_selling_x = ",total_selling_x)
       print("total_selling_y = ",total_selling_y)
 
@@ -4204,99 +4782,446 @@ class Dcl:
 
 
 
-def Replay_tx(start_block_height: int, end_block_height: int):
-   import requests,json
-   dcl = Dcl( protocol_fee_rate = 2000, name = "dcl" )
-   dcl.load_dcl_state()
-   
-   # 1. fetch tx from outside
-   # https://mainnet-indexer.ref-finance.com/get-dcl-pool-log?start_block_id=90891178&end_block_id=90894908
-   url = 'https://mainnet-indexer.ref-finance.com/get-dcl-pool-log?start_block_id='+str(start_block_height)+'&end_block_id='+str(end_block_height)
-   r = requests.get(url)
-   json_obj = json.loads(r.text)
-   
-   # 2. replay
-   tx_list = []
-   cnt = 0
-   for item in json_obj:
-      cnt+=1
-      if item['tx'] in tx_list:
-         continue
-      pool_id = ""
-      if "pool_id" in item:
-         pool_id = item['pool_id']
-      elif 'order_id' in item:
-         pool_id = item['order_id'].split('#')[0]
-      elif 'lpt_id' in item:
-         pool_id = item['lpt_id'].split('#')[0]
-      elif 'msg' in item:
-         msg = json.loads(item['msg'].replace("\\\"", "\""))
-         if 'LimitOrderWithSwap' in msg:
-            pool_id = msg['LimitOrderWithSwap']['pool_id']
-         elif 'LimitOrder' in msg:
-            pool_id = msg['LimitOrder']['pool_id']
-         elif 'Swap' in msg:
-            pool_id = msg['Swap']['pool_ids'][0]
-      else:
-         #print(item)
-         pass
-      
+# The most recent max_size tx hashes, for skipping events of a tx that was already replayed.
+# Membership and insertion are O(1), the oldest hash is evicted first. Events of one tx sit
+# next to each other in the log, so the window only has to be far larger than a tx.
+class RecentTxs:
+   def __init__(self, max_size: int = 1000000):
+      self.max_size = max_size
+      self.txs = set()
+      self.order = collections.deque()
 
-      if item['event_method'] == 'liquidity_added':
-         #add_liquidity(self, user_id, pool_id: str, left_point: int, right_point: int, amount_x: int, amount_y: int, min_amount_x: int, min_amount_y: int )
-         dcl.add_liquidity(item['operator'], pool_id, int(item['left_point']), int(item['right_point']), int(item['amount_x']), int(item['amount_y']), int(item['min_amount_x']), int(item['min_amount_y']) )
-
-      if item['event_method'] == 'liquidity_append':
-         #append_liquidity(self, user_id, lpt_id, amount_x, amount_y, min_amount_x, min_amount_y )
-         dcl.append_liquidity(item['operator'], item['lpt_id'], int(item['amount_x']), int(item['amount_y']), int(item['min_amount_x']), int(item['min_amount_y']) )
-
-      if item['event_method'] == 'liquidity_removed':
-         #remove_liquidity(self, user_id, lpt_id, amount, min_amount_x, min_amount_y)
-         #dcl.remove_liquidity(item['operator'], item['lpt_id'], int(item['amount']), int(item['min_amount_x']), int(item['min_amount_y']))
-         dcl.remove_liquidity(item['operator'], item['lpt_id'], int(item['amount']), 0, 0)
-
-      if item['event_method'] == 'order_added':
-         msg = json.loads(item['msg'].replace("\\\"", "\""))
-         if 'LimitOrderWithSwap' in msg:
-            #add_order_with_swap(self, client_id, user_id, token_id, amount, pool_id, point, buy_token)
-            dcl.add_order_with_swap("", item['operator'],item['token_contract'], int(item['amount']), pool_id, msg['LimitOrderWithSwap']['point'],msg['LimitOrderWithSwap']['buy_token'])
-         elif 'LimitOrder' in msg:
-            #add_order(self, client_id, user_id, token_id, amount, pool_id, point, buy_token, swapped_amount, swap_earn_amount )
-            dcl.add_order("", item['operator'],item['token_id'], int(item['amount']), pool_id, item['point'],item['buy_token'],int(item['swapped_amount']), int(item['swap_earn_amount']))
-            
-      if item['event_method'] == 'order_cancelled': # cancel_order include order_cancelled & order_completed event
-         #cancel_order(self, user_id, order_id, amount)
-         if item['amount'] == 'None':
-            dcl.cancel_order(item['operator'], item['order_id'], 0)
-         else:
-            dcl.cancel_order(item['operator'], item['order_id'], int(item['amount']))
+   def __contains__(self, tx: str):
+      return tx in self.txs
 
-      if item['event_method'] == 'order_completed': # means 
-         continue
-         
-      if item['event_method'] == 'swap':
-         msg = json.loads(item['msg'].replace("\\\"", "\""))
-         if 'LimitOrderWithSwap' in msg: # LimitOrderWithSwap will generate swap event. just skip
-            #add_order_with_swap(self, client_id, user_id, token_id, amount, pool_id, point, buy_token)
-            dcl.add_order_with_swap("", item['operator'],item['token_contract'], int(item['amount']), pool_id, msg['LimitOrderWithSwap']['point'],msg['LimitOrderWithSwap']['buy_token'])
-         else:
-            #swap(self, pool_ids, input_token: str, input_amount: int, output_token: str, min_output_amount: int )
-            dcl.swap(item['operator'],[pool_id], item['token_contract'], int(item['amount']), msg['Swap']['output_token'], int(msg['Swap']['min_output_amount']))
-            #dcl.swap(item['operator'],[pool_id], item['token_contract'], int(item['amount']), msg['Swap']['output_token'], 0)
+   def __len__(self):
+      return len(self.order)
 
-      tx_list.append(item['tx'])
+   def add(self, tx: str):
+      if tx in self.txs:
+         return
+      self.txs.add(tx)
+      self.order.append(tx)
+      if len(self.order) > self.max_size:
+         self.txs.discard(self.order.popleft())
+
+   # json-able state for checkpoints, oldest first
+   def get_state(self):
+      return {"max_size": self.max_size, "txs": list(self.order)}
+
+   def load_state(self, state: dict):
+      self.max_size = state["max_size"]
+      self.txs = set()
+      self.order = collections.deque()
+      for tx in state["txs"]:
+         self.add(tx)
+
+# Compare the previous list based tx de-dup with RecentTxs on event_num synthetic events,
+# each tx has 1 to 3 adjacent events. The list is only timed on the first list_event_num events.
+def tx_dedup_benchmark(event_num: int = 1000000, list_event_num: int = 20000):
+   import random
+   events = []
+   tx_id = 0
+   while len(events) < event_num:
+      tx_id += 1
+      events.extend(["tx%d" % tx_id] * random.randint(1, 3))
+   events = events[:event_num]
+
+   def replay(seen, add, events):
+      replayed = 0
+      for tx in events:
+         if tx in seen:
+            continue
+         replayed += 1
+         add(tx)
+      return replayed
 
+   tx_list = []
+   start = time.time()
+   list_replayed = replay(tx_list, tx_list.append, events[:list_event_num])
+   list_time = time.time() - start
+
+   recent_txs = RecentTxs()
+   start = time.time()
+   replayed = replay(recent_txs, recent_txs.add, events)
+   recent_time = time.time() - start
+
+   check_txs = RecentTxs()
+   if list_replayed != replay(check_txs, check_txs.add, events[:list_event_num]):
+      print("RecentTxs and list disagree on the first %d events" % list_event_num)
+   print("tx de-dup of %d events (%d txs):" % (event_num, tx_id))
+   print("   list: %.2fs for the first %d events" % (list_time, list_event_num))
+   print("   RecentTxs: %.2fs for all events, %d replayed" % (recent_time, replayed))
+
+# @param parallel: replay the events of each pool in a process of its own, see ReplayEngine.replay_parallel
+# @param max_workers: worker processes of the parallel replay, None for one per core
+# @param resume: start from the newest checkpoint in checkpoint_dir instead of the snapshot files, if there is one from start_block_height - 1 on
+# @param checkpoint_blocks: save a checkpoint after every checkpoint_blocks blocks, None for none
+def Replay_tx(start_block_height: int, end_block_height: int, use_sqrt_price_table: bool = False, use_slot_index: bool = False, blocks_per_page: int = 10000, parallel: bool = False, max_workers: int = None, resume: bool = False, checkpoint_blocks: int = None, checkpoint_dir: str = './dcl_checkpoints', snapshot_filepath: str = None):
+   checkpoints = ReplayCheckpoints(checkpoint_dir)
+   tx_list = RecentTxs()
+   # a checkpoint before start_block_height is older than the snapshot files
+   checkpoint = checkpoints.load_latest(start_block_height - 1) if resume else None
+   if checkpoint is None:
+      dcl = Dcl( protocol_fee_rate = 2000, name = "dcl" )
+      if snapshot_filepath is None:
+         dcl.load_dcl_state()
+      else:
+         # only the pools the replay touches get decoded
+         dcl.load_dcl_snapshot(snapshot_filepath, lazy = True)
+   else:
+      (block_height, dcl, txs_state) = checkpoint
+      tx_list.load_state(txs_state)
+      print("resume from block", block_height + 1)
+      start_block_height = block_height + 1
+   if use_sqrt_price_table:
+      enable_sqrt_price_table(dcl.get_point_deltas())
+   if use_slot_index:
+      dcl.enable_slot_index()
    
+   # 1. fetch tx from outside, page by page while replaying
+   # https://mainnet-indexer.ref-finance.com/get-dcl-pool-log?start_block_id=90891178&end_block_id=90894908
+   # 2. replay, with a checkpoint after every checkpoint_blocks blocks
+   engine = ReplayEngine(dcl)
+   window_start = start_block_height
+   while window_start <= end_block_height:
+      window_end = end_block_height
+      if checkpoint_blocks:
+         window_end = min(window_start + checkpoint_blocks - 1, end_block_height)
+      events = iter_dcl_pool_log(window_start, window_end, blocks_per_page)
+      if parallel:
+         if use_sqrt_price_table:
+            engine.replay_parallel(events, tx_list, max_workers, initializer = enable_sqrt_price_table, initargs = (dcl.get_point_deltas(), ))
+         else:
+            engine.replay_parallel(events, tx_list, max_workers)
+      else:
+         engine.replay(events, tx_list)
+      if checkpoint_blocks:
+         checkpoints.save(dcl, tx_list, window_end)
+      window_start = window_end + 1
+   checkpoints.wait()
+   engine.print_stats()
+
    # 3. save the result to file
    dcl.dump_pools_stats_data()
 
 
+# Compare memory of point_info loaded from dcl_pointinfo.json with the __slots__ classes
+# against the previous layout, where each LiquidityData/OrderData took its json dict as __dict__
+# and the raw json had to stay alive.
+def point_info_memory_report(filepath = "./dcl_pointinfo.json"):
+   import gc
+   import tracemalloc
+
+   class DictBacked:
+      pass
+
+   def load_dict_backed():
+      dcl_pointinfo = OpenFile(filepath)
+      pools = {}
+      for pool_id, point_info in dcl_pointinfo.items():
+         data = {}
+         for key, value in point_info.items():
+            point_data = DictBacked()
+            point_data.liquidity_data = DictBacked()
+            point_data.order_data = DictBacked()
+            if len(value['liquidity_data']) > 0:
+               point_data.liquidity_data.__dict__ = value['liquidity_data']
+            if len(value['order_data']) > 0:
+               point_data.order_data.__dict__ = value['order_data']
+            data[int(key)] = point_data
+         pools[pool_id] = data
+      return pools
+
+   def load_slotted():
+      dcl_pointinfo = OpenFile(filepath)
+      pools = {}
+      for pool_id, point_info in dcl_pointinfo.items():
+         pools[pool_id] = PointInfo()
+         pools[pool_id].load_point_info(point_info)
+      return pools
+
+   report = {}
+   for (name, load) in (("dict", load_dict_backed), ("slots", load_slotted)):
+      gc.collect()
+      tracemalloc.start()
+      pools = load()
+      gc.collect()
+      report[name] = tracemalloc.get_traced_memory()[0]
+      tracemalloc.stop()
+      point_num = sum(len(data) if isinstance(data, dict) else len(data.data) for data in pools.values())
+      del pools
+
+   print("point_info memory of %d points in %d pools:" % (point_num, len(OpenFile(filepath))))
+   print("   dict layout: %.1f MB, %.0f bytes/point" % (report["dict"] / 2**20, report["dict"] / max(point_num, 1)))
+   print("   slots layout: %.1f MB, %.0f bytes/point" % (report["slots"] / 2**20, report["slots"] / max(point_num, 1)))
+   return report
+
+# Convert the state files read by Dcl.load_dcl_state into one binary snapshot for Dcl.load_dcl_snapshot.
+# Point info, slot bitmaps, user liquidities and orders become tables of columns, the small files stay json.
+def convert_dcl_state(filepath = './dcl_state.snap'):
+   import binascii
+   dcl_root = OpenFile("./dcl_root.json")
+   dcl_pool = OpenFile("./dcl_pool.json")
+   dcl_user_liquidities = OpenFile("./dcl_user_liquidities.json")
+   dcl_user_orders = OpenFile("./dcl_user_orders.json")
+   dcl_pointinfo = OpenFile("./dcl_pointinfo.json")
+   dcl_slotbitmap = OpenFile("./dcl_slotbitmap.json")
+   dcl_vip_users = OpenFile("./dcl_vip_users.json")
+
+   snapshot = SnapshotWriter()
+   snapshot.add_json("root", dcl_root)
+   snapshot.add_json("pool", dcl_pool)
+   snapshot.add_json("vip_users", dcl_vip_users)
+
+   # fields missing in the json keep the default of load_point_info
+   liquidity_defaults = get_slots_state(LiquidityData())
+   order_defaults = get_slots_state(OrderData())
+   for pool_data in dcl_pool.values():
+      pool_id = pool_data['pool_id']
+      columns = {'point': []}
+      for k in LiquidityData.__slots__:
+         columns['liquidity_data.' + k] = []
+      for k in OrderData.__slots__:
+         columns['order_data.' + k] = []
+      for key, value in dcl_pointinfo[pool_id].items():
+         columns['point'].append(int(key))
+         for (k, default_value) in zip(LiquidityData.__slots__, liquidity_defaults):
+            columns['liquidity_data.' + k].append(value['liquidity_data'].get(k, default_value))
+         for (k, default_value) in zip(OrderData.__slots__, order_defaults):
+            columns['order_data.' + k].append(value['order_data'].get(k, default_value))
+      snapshot.add_table("pointinfo:" + pool_id, columns)
+
+      slot_bitmap = dcl_slotbitmap[pool_id]
+      snapshot.add_table("slotbitmap:" + pool_id, {
+         'word': [int(key) for key in slot_bitmap.keys()],
+         'value': [int.from_bytes(binascii.a2b_hex(value), 'little', signed = False) for value in slot_bitmap.values()]})
+
+   for (name, user_items, fields) in (("user_liquidities", dcl_user_liquidities, USER_LIQUIDITY_FIELDS), ("user_orders", dcl_user_orders, USER_ORDER_FIELDS)):
+      columns = {k: [] for k in ('key', ) + fields}
+      for items in user_items.values():
+         for key, item in items.items():
+            columns['key'].append(key)
+            for k in fields:
+               columns[k].append(item.get(k, MISSING))
+      snapshot.add_table(name, columns)
+
+   snapshot.save(filepath)
+
+# Load the state with Dcl.load_dcl_state, the reference, and with Dcl.load_dcl_snapshot, eager and lazy.
+# Raise if they differ, else print the time of each, where lazy excludes decoding the pools.
+def dcl_snapshot_report(filepath = './dcl_state.snap'):
+   def load(name):
+      dcl = Dcl( protocol_fee_rate = 2000, name = "dcl" )
+      start = time.time()
+      if name == "json":
+         dcl.load_dcl_state()
+      else:
+         dcl.load_dcl_snapshot(filepath, lazy = (name == "lazy"))
+      elapsed = time.time() - start
+      dcl.load_lazy_pools()
+      return (dcl, elapsed)
+
+   def get_state(dcl):
+      pools = {}
+      for pool_id, pool in dcl.pools.items():
+         # parent_name only labels the logs, lazy pools take the name of dcl when decoded
+         pools[pool_id] = {k: v for k, v in vars(pool).items() if k not in ('point_info', 'slot_bitmap', 'parent_name')}
+         pools[pool_id]['point_info'] = {point: (default(point_data.liquidity_data), default(point_data.order_data)) for point, point_data in pool.point_info.data.items()}
+         pools[pool_id]['slot_bitmap'] = pool.slot_bitmap.data
+      return {
+         "latest_liquidity_id": dcl.latest_liquidity_id,
+         "latest_order_id": dcl.latest_order_id,
+         "pools": pools,
+         "user_liquidities": {k: vars(v) for k, v in dcl.user_liquidities.items()},
+         "user_orders": {k: vars(v) for k, v in dcl.user_orders.items()},
+         "vip_users": dcl.vip_users}
+
+   (json_dcl, json_time) = load("json")
+   json_state = get_state(json_dcl)
+   json_dcl = None
+   times = [json_time]
+   for name in ("snapshot", "lazy"):
+      (snapshot_dcl, snapshot_time) = load(name)
+      snapshot_state = get_state(snapshot_dcl)
+      for k in json_state.keys():
+         if json_state[k] != snapshot_state[k]:
+            raise Exception("load_dcl_snapshot(lazy = %s) differs from load_dcl_state on %s" % (name == "lazy", k))
+      times.append(snapshot_time)
+   print("load_dcl_state: %.2fs, load_dcl_snapshot: %.2fs, lazy: %.2fs, same state" % tuple(times))
+   return tuple(times)
+
+# Dcl with one tx.near|ty.near pool per fee, random liquidity around point 0 and limit orders on both sides,
+# for the self checks
+def build_check_dcl(seed: int, fees = (100, 400, 2000, 10000), orders: bool = True):
+   import random
+   random.seed(seed)
+   dcl = Dcl( protocol_fee_rate = 2000, name = "check" )
+   for fee in fees:
+      dcl.create_pool("tx.near", "ty.near", fee, 0)
+      pool_id = gen_pool_id("tx.near", "ty.near", fee)
+      point_delta = dcl.get_pool(pool_id).point_delta
+      dcl.add_liquidity("w", pool_id, -6000 // point_delta * point_delta, 6000 // point_delta * point_delta, 10**27, 10**27, 0, 0)
+      for i in range(12):
+         left_point = random.randint(-300, 280) * point_delta
+         right_point = left_point + random.randint(1, 60) * point_delta
+         dcl.add_liquidity("u%d" % i, pool_id, left_point, right_point, 10**24, 10**24, 0, 0)
+      if orders:
+         for i in range(6):
+            dcl.add_order("", "o%d" % i, "tx.near", random.randint(10**18, 10**21), pool_id, random.randint(1, 100) * point_delta, "ty.near", 0, 0)
+            dcl.add_order("", "q%d" % i, "ty.near", random.randint(10**18, 10**21), pool_id, -random.randint(1, 100) * point_delta, "tx.near", 0, 0)
+   return dcl
+
+# Dcl.quote_many must give what a quote of each amount on its own gives
+def quote_many_self_check(seed: int = 1):
+   import random
+   import contextlib
+   import io
+   with contextlib.redirect_stdout(io.StringIO()):
+      dcl = build_check_dcl(seed)
+      random.seed(seed)
+      for pool_id in dcl.pools.keys():
+         for (input_token, output_token) in (("tx.near", "ty.near"), ("ty.near", "tx.near")):
+            amounts = [random.randint(0, 10**random.randint(1, 25)) for _ in range(100)] + [0, 1, 2, 10**30]
+            many = dcl.quote_many([pool_id], input_token, output_token, amounts)
+            single = [dcl.quote("check", [pool_id], input_token, output_token, amount, "check")["amount"] for amount in amounts]
+            if many != single:
+               return False
+   return True
+
+# an indexed Slot_BitMap must find the same nearest valued slots as a plain one, zero words loaded included
+def slot_index_self_check(seed: int = 1):
+   import random
+   random.seed(seed)
+   for point_delta in (1, 8, 40, 200):
+      loaded = {"3": "00" * 32, "5": "01" + "00" * 31, "-2": "00" * 31 + "80", "-7": "00" * 32}
+      plain = Slot_BitMap()
+      plain.load_slot_bitmap(loaded)
+      indexed = Slot_BitMap(use_index = True)
+      indexed.load_slot_bitmap(loaded)
+      for _ in range(3000):
+         slot = random.randint(-2048, 2048)
+         action = random.random()
+         if action < 0.3:
+            plain.set_one(slot * point_delta, point_delta)
+            indexed.set_one(slot * point_delta, point_delta)
+         elif action < 0.6:
+            plain.set_zero(slot * point_delta, point_delta)
+            indexed.set_zero(slot * point_delta, point_delta)
+         point = random.randint(-2100, 2100) * point_delta + random.randint(0, point_delta - 1)
+         left_stop = random.randint(-2100, 2100)
+         right_stop = random.randint(-2100, 2100)
+         if plain.get_nearest_left_valued_slot(point, point_delta, left_stop) != indexed.get_nearest_left_valued_slot(point, point_delta, left_stop):
+            return False
+         if plain.get_nearest_right_valued_slot(point, point_delta, right_stop) != indexed.get_nearest_right_valued_slot(point, point_delta, right_stop):
+            return False
+      if indexed.word_index != sorted(k for k, v in indexed.data.items() if v):
+         return False
+   return True
+
+# a made up indexer log over the pools of dcl, with multi-hop swaps, orders placed by swaps and duplicates
+def gen_check_dcl_log(dcl, seed: int, event_count: int):
+   import random
+   random.seed(seed)
+   pool_ids = sorted(dcl.pools.keys())
+   latest_liquidity_id = dcl.latest_liquidity_id
+   latest_order_id = dcl.latest_order_id
+   lpt_ids = {pool_id: [] for pool_id in pool_ids}
+   events = []
+   for n in range(event_count):
+      tx = "tx%d" % n
+      pool_id = random.choice(pool_ids)
+      point_delta = dcl.get_pool(pool_id).point_delta
+      r = random.random()
+      if r < 0.2:
+         left_point = random.randint(-200, 200) * point_delta
+         operator = "a%d" % random.randint(0, 3)
+         events.append({"tx": tx, "event_method": "liquidity_added", "operator": operator, "pool_id": pool_id, "left_point": str(left_point),
+                        "right_point": str(left_point + random.randint(1, 40) * point_delta), "amount_x": str(10**22), "amount_y": str(10**22), "min_amount_x": "0", "min_amount_y": "0"})
+         latest_liquidity_id += 1
+         lpt_ids[pool_id].append((operator, pool_id + "#" + str(latest_liquidity_id)))
+      elif r < 0.3 and lpt_ids[pool_id]:
+         (operator, lpt_id) = random.choice(lpt_ids[pool_id])
+         events.append({"tx": tx, "event_method": "liquidity_append", "operator": operator, "lpt_id": lpt_id, "amount_x": str(10**20), "amount_y": str(10**20), "min_amount_x": "0", "min_amount_y": "0"})
+      elif r < 0.35 and lpt_ids[pool_id]:
+         (operator, lpt_id) = lpt_ids[pool_id].pop(0)
+         events.append({"tx": tx, "event_method": "liquidity_removed", "operator": operator, "lpt_id": lpt_id, "amount": str(random.choice([10**10, 10**40])), "min_amount_x": "0", "min_amount_y": "0"})
+      elif r < 0.5:
+         point = random.randint(20000, 30000) // point_delta * point_delta
+         msg = json.dumps({"LimitOrder": {"pool_id": pool_id, "point": point, "buy_token": "ty.near"}}).replace('"', '\\"')
+         operator = "o%d" % random.randint(0, 3)
+         latest_order_id += 1
+         order_id = pool_id + "#" + str(latest_order_id)
+         events.append({"tx": tx, "event_method": "order_added", "operator": operator, "order_id": order_id, "token_id": "tx.near", "amount": str(10**19),
+                        "point": point, "buy_token": "ty.near", "swapped_amount": "0", "swap_earn_amount": "0", "msg": msg})
+         if random.random() < 0.5:
+            events.append({"tx": tx + "c", "event_method": "order_completed", "operator": operator, "order_id": order_id})
+            events.append({"tx": tx + "c", "event_method": "order_cancelled", "operator": operator, "order_id": order_id, "amount": random.choice(["None", str(10**5)])})
+      elif r < 0.55:
+         events.append({"tx": tx, "event_method": "lostfound", "operator": "x"})
+      elif r < 0.58:
+         # far below the current point, the swap doesn't finish and mostly places an order
+         point = -random.randint(20000, 30000) // point_delta * point_delta
+         msg = json.dumps({"LimitOrderWithSwap": {"pool_id": pool_id, "point": point, "buy_token": "tx.near"}}).replace('"', '\\"')
+         events.append({"tx": tx, "event_method": "swap", "operator": "w", "token_contract": "ty.near", "amount": str(10**17), "msg": msg})
+         latest_order_id += 1
+         if random.random() < 0.9:
+            events.append({"tx": tx, "event_method": "order_added", "operator": "w", "order_id": pool_id + "#" + str(latest_order_id), "msg": msg})
+      elif r < 0.62:
+         msg = json.dumps({"Swap": {"pool_ids": [pool_id, random.choice(pool_ids)], "output_token": "ty.near", "min_output_amount": "0"}}).replace('"', '\\"')
+         events.append({"tx": tx, "event_method": "swap", "operator": "s", "token_contract": "tx.near", "amount": str(10**16), "msg": msg})
+      else:
+         (input_token, output_token) = random.choice([("tx.near", "ty.near"), ("ty.near", "tx.near")])
+         msg = json.dumps({"Swap": {"pool_ids": [pool_id], "output_token": output_token, "min_output_amount": "0"}}).replace('"', '\\"')
+         events.append({"tx": tx, "event_method": "swap", "operator": "s", "token_contract": input_token, "amount": str(random.randint(10**16, 10**19)), "msg": msg})
+      if random.random() < 0.1:
+         events.append(dict(events[-1]))
+   return events
+
+def get_check_dcl_state(dcl):
+   orders = {order_id: {k: v for k, v in default(order).items() if k != "created_at"} for order_id, order in dcl.user_orders.items()}
+   return json.dumps([dcl.pools, dcl.user_liquidities, orders, {user_id: user.completed_order_count for user_id, user in dcl.users.items()},
+                      dcl.liquidity_count, dcl.latest_liquidity_id, dcl.latest_order_id], default = default, sort_keys = True)
+
+# ReplayEngine.replay_parallel must leave the same state and stats as a serial replay
+def replay_parallel_self_check(seed: int = 1):
+   import contextlib
+   import io
+   from dcl_replay import replay_order_completed
+   for (chunk_size, pool_less) in ((100000, False), (50, False), (120, True)):
+      with contextlib.redirect_stdout(io.StringIO()):
+         serial_dcl = build_check_dcl(seed, orders = False)
+         parallel_dcl = build_check_dcl(seed, orders = False)
+         events = gen_check_dcl_log(serial_dcl, seed, 1500)
+         serial = ReplayEngine(serial_dcl)
+         parallel = ReplayEngine(parallel_dcl)
+         if pool_less:
+            # a handled event whose pools can't be told ends the segment
+            serial.register("lostfound", replay_order_completed)
+            parallel.register("lostfound", replay_order_completed)
+         serial.replay(events, RecentTxs())
+         parallel.replay_parallel(events, RecentTxs(), 4, chunk_size = chunk_size)
+      if get_check_dcl_state(serial_dcl) != get_check_dcl_state(parallel_dcl):
+         return False
+      if {k: v[0] for k, v in serial.stats.items()} != {k: v[0] for k, v in parallel.stats.items()} or serial.duplicate_count != parallel.duplicate_count:
+         return False
+      seed += 1
+   return True
+
+# python dcl_sim.py check
+def self_check():
+   run_self_checks([("quote_many", quote_many_self_check), ("slot_index", slot_index_self_check), ("replay_parallel", replay_parallel_self_check)])
+
 def generate_endpoint_stats():
    fetch_dcl_files_from_s3(Cfg.LAST_BLOCK_ID)
    Replay_tx(Cfg.LAST_BLOCK_ID+1, Cfg.BLOCK_ID)
 
 
 if __name__ == "__main__":
+   if sys.argv[1:] == ["check"]:
+      self_check()
+      sys.exit(0)
+
    from utils import get_last_block_height
    # replay
    (block_height1, block_height2) = get_last_two_block_height_from_all_s3_folders_list()
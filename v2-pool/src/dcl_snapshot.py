@@ -0,0 +1,206 @@
+# binary snapshot of the dcl state files, written by convert_dcl_state and read by Dcl.load_dcl_snapshot in dcl_sim
+# file: magic, version, section table, sections
+# section: a json document, or a table of columns where each column is one of
+#    int64 array, fixed width big-int, '\0' joined strings or a json list,
+#    with a mask of rows that miss the field or are 0 and left out
+# a reader can map the file instead of reading it, then only the sections decoded are paged in
+
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+
+SNAPSHOT_MAGIC = b"DCLSNAP\0"
+SNAPSHOT_VERSION = 1
+
+SECTION_JSON = 0
+SECTION_TABLE = 1
+
+COLUMN_INT64 = 0
+COLUMN_BIGINT = 1
+COLUMN_STR = 2
+COLUMN_JSON = 3
+
+# value of a column in the rows that don't have the field
+class Missing:
+   def __repr__(self):
+      return "MISSING"
+
+MISSING = Missing()
+
+INT64_MIN = -2**63
+INT64_MAX = 2**63 - 1
+
+def encode_column(values: list):
+   if all(type(v) is int for v in values):
+      if all(INT64_MIN <= v <= INT64_MAX for v in values):
+         column = array('q', values)
+         if sys.byteorder == 'big':
+            column.byteswap()
+         return (COLUMN_INT64, column.tobytes())
+      width = max((v if v >= 0 else ~v).bit_length() // 8 + 1 for v in values)
+      return (COLUMN_BIGINT, struct.pack('<H', width) + b''.join(v.to_bytes(width, 'little', signed = True) for v in values))
+   if all(type(v) is str and '\0' not in v for v in values):
+      return (COLUMN_STR, '\0'.join(values).encode('utf-8'))
+   return (COLUMN_JSON, json.dumps(values, separators = (',', ':')).encode('utf-8'))
+
+def decode_column(kind: int, payload, count: int):
+   if count == 0:
+      return []
+   if kind == COLUMN_INT64:
+      column = array('q')
+      column.frombytes(payload)
+      if sys.byteorder == 'big':
+         column.byteswap()
+      return column.tolist()
+   if kind == COLUMN_BIGINT:
+      (width, ) = struct.unpack_from('<H', payload)
+      from_bytes = int.from_bytes
+      return [from_bytes(payload[i:i + width], 'little', signed = True) for i in range(2, 2 + count * width, width)]
+   if kind == COLUMN_STR:
+      return str(payload, 'utf-8').split('\0')
+   if kind == COLUMN_JSON:
+      return json.loads(str(payload, 'utf-8'))
+   raise Exception("Unknown snapshot column kind %s" % kind)
+
+# rows of a column that have no value, or whose value is 0 and left out
+MASK_NONE = 0
+MASK_MISSING = 1
+MASK_ZERO = 2
+
+# table section: rows, columns, then per column name, kind, mask and payload
+def encode_table(columns: dict):
+   rows = len(next(iter(columns.values()))) if columns else 0
+   parts = [struct.pack('<IH', rows, len(columns))]
+   for name, values in columns.items():
+      if len(values) != rows:
+         raise Exception("Column %s has %d rows instead of %d" % (name, len(values), rows))
+      mask_kind = MASK_NONE
+      mask = bytes(0 if v is MISSING else 1 for v in values)
+      if 0 in mask:
+         mask_kind = MASK_MISSING
+      else:
+         mask = bytes(0 if type(v) is int and v == 0 else 1 for v in values)
+         if mask.count(0) * 2 > rows:
+            mask_kind = MASK_ZERO
+      if mask_kind != MASK_NONE:
+         values = [v for (v, m) in zip(values, mask) if m]
+      (kind, payload) = encode_column(values)
+      name = name.encode('utf-8')
+      parts.append(struct.pack('<H', len(name)) + name)
+      parts.append(struct.pack('<BBQ', kind, mask_kind, len(payload)))
+      if mask_kind != MASK_NONE:
+         parts.append(mask)
+      parts.append(payload)
+   return b''.join(parts)
+
+def decode_table(buf):
+   buf = memoryview(buf)
+   (rows, column_count) = struct.unpack_from('<IH', buf)
+   offset = 6
+   columns = {}
+   for _ in range(column_count):
+      (name_len, ) = struct.unpack_from('<H', buf, offset)
+      name = str(buf[offset + 2:offset + 2 + name_len], 'utf-8')
+      offset += 2 + name_len
+      (kind, mask_kind, payload_len) = struct.unpack_from('<BBQ', buf, offset)
+      offset += 10
+      mask = None
+      if mask_kind != MASK_NONE:
+         mask = bytes(buf[offset:offset + rows])
+         offset += rows
+      payload = bytes(buf[offset:offset + payload_len])
+      offset += payload_len
+      if mask is None:
+         columns[name] = decode_column(kind, payload, rows)
+      else:
+         values = iter(decode_column(kind, payload, rows - mask.count(0)))
+         absent = MISSING if mask_kind == MASK_MISSING else 0
+         columns[name] = [next(values) if m else absent for m in mask]
+   return columns
+
+
+class SnapshotWriter:
+   def __init__(self):
+      self.sections = []
+
+   def add_json(self, name: str, obj):
+      self.sections.append((name, SECTION_JSON, json.dumps(obj, separators = (',', ':')).encode('utf-8')))
+
+   # @param columns: {column name: [value of each row]}, MISSING for rows without the field
+   def add_table(self, name: str, columns: dict):
+      self.sections.append((name, SECTION_TABLE, encode_table(columns)))
+
+   def save(self, filepath: str):
+      names = [name.encode('utf-8') for (name, _, _) in self.sections]
+      offset = len(SNAPSHOT_MAGIC) + 8 + sum(2 + len(name) + 17 for name in names)
+      header = [SNAPSHOT_MAGIC, struct.pack('<II', SNAPSHOT_VERSION, len(self.sections))]
+      for (name, (_, kind, payload)) in zip(names, self.sections):
+         header.append(struct.pack('<H', len(name)) + name + struct.pack('<BQQ', kind, offset, len(payload)))
+         offset += len(payload)
+      with open(filepath + ".tmp", 'wb') as f:
+         for part in header:
+            f.write(part)
+         for (_, _, payload) in self.sections:
+            f.write(payload)
+      os.replace(filepath + ".tmp", filepath)
+      print("%s saved" % filepath)
+
+
+class SnapshotReader:
+   # @param use_mmap: map the file, sections are read from disk when decoded
+   def __init__(self, filepath: str, use_mmap: bool = False):
+      self.filepath = filepath
+      self.use_mmap = use_mmap
+      with open(filepath, 'rb') as f:
+         st = os.fstat(f.fileno())
+         self.file_stat = (st.st_size, st.st_mtime_ns)
+         if use_mmap:
+            self.buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+         else:
+            self.buf = f.read()
+      if self.buf[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+         raise Exception("%s is not a dcl snapshot" % filepath)
+      offset = len(SNAPSHOT_MAGIC)
+      (self.version, section_count) = struct.unpack_from('<II', self.buf, offset)
+      if self.version != SNAPSHOT_VERSION:
+         raise Exception("Unsupported snapshot version %s of %s" % (self.version, filepath))
+      offset += 8
+      # name -> (kind, offset, length)
+      self.sections = {}
+      for _ in range(section_count):
+         (name_len, ) = struct.unpack_from('<H', self.buf, offset)
+         name = bytes(self.buf[offset + 2:offset + 2 + name_len]).decode('utf-8')
+         offset += 2 + name_len
+         self.sections[name] = struct.unpack_from('<BQQ', self.buf, offset)
+         offset += 17
+
+   # pickled as its file, which is opened again on unpickling and must not have changed meanwhile
+   def __getstate__(self):
+      return (self.filepath, self.use_mmap, self.file_stat)
+
+   def __setstate__(self, state):
+      (filepath, use_mmap, file_stat) = state
+      self.__init__(filepath, use_mmap)
+      if self.file_stat != file_stat:
+         raise Exception("%s changed since it was loaded" % filepath)
+
+   def has_section(self, name: str):
+      return name in self.sections
+
+   def get_payload(self, name: str, kind: int):
+      if name not in self.sections:
+         raise Exception("Snapshot has no section %s" % name)
+      (section_kind, offset, length) = self.sections[name]
+      if section_kind != kind:
+         raise Exception("Snapshot section %s is of kind %s" % (name, section_kind))
+      return memoryview(self.buf)[offset:offset + length]
+
+   def get_json(self, name: str):
+      return json.loads(str(self.get_payload(name, SECTION_JSON), 'utf-8'))
+
+   # @return {column name: [value of each row]}
+   def get_table(self, name: str):
+      return decode_table(self.get_payload(name, SECTION_TABLE))
@@ -375,6 +375,7 @@ def y_swap_x_range_complete_desire( liquidity: int, sqrt_price_l_96: int, left_p
 # @return tuple (cost_x, acquire_y)
 # x_swap_y_at_price_desire( desire_y: u128, sqrt_price_96: U256,curr_y: u128 )
 def x_swap_y_at_price_desire( desire_y: int, sqrt_price_96: int,curr_y: int ):
+   acquire_y = desire_y
    if acquire_y > curr_y:
       acquire_y = curr_y
 
@@ -0,0 +1,90 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import base64
+
+from near_special_rpc import SpecialNodeJsonProvider, SpecialNodeJsonProviderError
+
+
+# token bucket of rate requests per second, up to burst at once
+class AsyncRateLimiter(object):
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = None
+
+    async def acquire(self):
+        # created on first use so the limiter is bound to the loop that runs it
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Async sibling of SpecialNodeJsonProvider for the bulk view calls of one node.
+# At most max_concurrency calls are in flight and rate_limit caps the calls per second, None for no cap.
+# The calls run on the keep-alive session of a SpecialNodeJsonProvider in worker threads, so no async http client is needed.
+class AsyncSpecialNodeJsonProvider(object):
+
+    def __init__(self, node, max_concurrency=16, rate_limit=None):
+        self._provider = SpecialNodeJsonProvider(node, pool_size=max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._max_concurrency = max_concurrency
+        self._semaphore = None
+        self._rate_limiter = AsyncRateLimiter(rate_limit) if rate_limit else None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def rpc_addr(self):
+        return self._provider.rpc_addr()
+
+    # run fn(provider, *args) in a worker thread, under the limits of the calls, e.g. state_dump.save_view_state
+    async def run(self, fn, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        async with self._semaphore:
+            if self._rate_limiter is not None:
+                await self._rate_limiter.acquire()
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, self._provider, *args)
+
+    async def json_rpc(self, method, params, timeout=300):
+        return await self.run(SpecialNodeJsonProvider.json_rpc, method, params, timeout)
+
+    async def query(self, query_object):
+        return await self.json_rpc('query', query_object)
+
+    async def view_call(self, account_id, method_name, args, finality='optimistic'):
+        return await self.json_rpc('query', {"request_type": "call_function", "account_id": account_id,
+                                             "method_name": method_name, "args_base64": base64.b64encode(args).decode('utf8'), "finality": finality})
+
+    async def view_call_at_height(self, account_id, method_name, args, block_id):
+        return await self.json_rpc('query', {"request_type": "call_function", "account_id": account_id,
+                                             "method_name": method_name, "args_base64": base64.b64encode(args).decode('utf8'), "block_id": int(block_id)})
+
+    async def get_block(self, block_id):
+        return await self.json_rpc('block', [block_id])
+
+    async def get_changes_in_block(self, changes_in_block_request):
+        return await self.json_rpc('EXPERIMENTAL_changes_in_block', changes_in_block_request)
+
+
+if __name__ == "__main__":
+    pass
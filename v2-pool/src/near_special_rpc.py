@@ -1,15 +1,30 @@
 import requests
+from requests.adapters import HTTPAdapter
 import base64
 import json
 
+from check_helpers import StubHandler, StubServer, run_self_checks
+
 class SpecialNodeJsonProviderError(Exception):
     pass
 
 
+# json-rpc error codes of a node answering a batch as a whole with an invalid request or parse error,
+# taken as the node not taking batches
+BATCH_UNSUPPORTED_ERROR_CODES = (-32600, -32700)
+
+
 class SpecialNodeJsonProvider(object):
 
-    def __init__(self, node):
+    # @param pool_size: keep-alive connections kept to the node, for callers sharing the provider across threads
+    def __init__(self, node, pool_size=10):
         self._rpc_addr = node
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        # cleared when the node refuses a batch as an invalid request, later batches are sent call by call
+        self._batch_supported = True
 
     def rpc_addr(self):
         return self._rpc_addr
@@ -21,13 +36,67 @@ class SpecialNodeJsonProvider(object):
             'id': 0,
             'jsonrpc': '2.0'
         }
-        r = requests.post(self.rpc_addr(), json=j, timeout=timeout)
+        r = self._session.post(self.rpc_addr(), json=j, timeout=timeout)
         r.raise_for_status()
         content = json.loads(r.content)
         if "error" in content:
             raise SpecialNodeJsonProviderError(content["error"])
         return content["result"]
 
+    # response of a call with its body left unread, for the caller to stream and close
+    def json_rpc_stream(self, method, params, timeout=300):
+        j = {
+            'method': method,
+            'params': params,
+            'id': 0,
+            'jsonrpc': '2.0'
+        }
+        r = self._session.post(self.rpc_addr(), json=j, timeout=timeout, stream=True)
+        r.raise_for_status()
+        return r
+
+    # Send many calls as json-rpc batches of up to batch_size calls each.
+    # A node that doesn't take batches gets the calls one by one over the same connection.
+    # @param calls: [(method, params), ...]
+    # @param return_errors: put a SpecialNodeJsonProviderError in place of each failed call instead of raising the first
+    # @return results in the order of calls
+    def json_rpc_batch(self, calls, timeout=300, batch_size=100, return_errors=False):
+        results = []
+        for start in range(0, len(calls), batch_size):
+            batch = calls[start:start + batch_size]
+            contents = None
+            if self._batch_supported:
+                j = [{'method': method, 'params': params, 'id': i, 'jsonrpc': '2.0'} for i, (method, params) in enumerate(batch)]
+                r = self._session.post(self.rpc_addr(), json=j, timeout=timeout)
+                r.raise_for_status()
+                content = json.loads(r.content)
+                if isinstance(content, list):
+                    contents = sorted(content, key=lambda c: c['id'])
+                    if [c['id'] for c in contents] != list(range(len(batch))):
+                        raise SpecialNodeJsonProviderError("batch response ids don't match the calls")
+                else:
+                    error = content.get('error')
+                    if not isinstance(error, dict) or error.get('code') not in BATCH_UNSUPPORTED_ERROR_CODES:
+                        raise SpecialNodeJsonProviderError(error if error is not None else content)
+                    self._batch_supported = False
+
+            if contents is None:
+                contents = []
+                for (method, params) in batch:
+                    try:
+                        contents.append({'result': self.json_rpc(method, params, timeout=timeout)})
+                    except SpecialNodeJsonProviderError as e:
+                        contents.append({'error': e.args[0]})
+
+            for content in contents:
+                if "error" in content:
+                    if not return_errors:
+                        raise SpecialNodeJsonProviderError(content["error"])
+                    results.append(SpecialNodeJsonProviderError(content["error"]))
+                else:
+                    results.append(content["result"])
+        return results
+
     def send_tx(self, signed_tx):
         return self.json_rpc('broadcast_tx_async', [base64.b64encode(signed_tx).decode('utf8')])
 
@@ -35,7 +104,7 @@ class SpecialNodeJsonProvider(object):
         return self.json_rpc('broadcast_tx_commit', [base64.b64encode(signed_tx).decode('utf8')], timeout=timeout)
 
     def get_status(self):
-        r = requests.get("%s/status" % self.rpc_addr(), timeout=2)
+        r = self._session.get("%s/status" % self.rpc_addr(), timeout=2)
         r.raise_for_status()
         return json.loads(r.content)
     
@@ -48,6 +117,9 @@ class SpecialNodeJsonProvider(object):
     def query(self, query_object):
         return self.json_rpc('query', query_object)
 
+    def query_batch(self, query_objects, return_errors=False):
+        return self.json_rpc_batch([('query', query_object) for query_object in query_objects], return_errors=return_errors)
+
     def get_account(self, account_id, finality='optimistic'):
         return self.json_rpc('query', {"request_type": "view_account", "account_id": account_id, "finality": finality})
 
@@ -100,5 +172,55 @@ class SpecialNodeJsonProvider(object):
     
         return ret
 
+# json_rpc_batch against a local stub node, taking batches or not, or failing a batch with a server error
+def batch_self_check():
+    class StubNode(StubHandler):
+        reply = "batch"
+
+        def do_POST(self):
+            body = self.read_json()
+
+            def one(call):
+                if call['params']['account_id'] == 'bad':
+                    return {'jsonrpc': '2.0', 'id': call['id'], 'error': {'name': 'HANDLER_ERROR'}}
+                return {'jsonrpc': '2.0', 'id': call['id'], 'result': {'echo': call['params']['account_id']}}
+            if not isinstance(body, list):
+                self.send_json(one(body))
+            elif self.reply == "batch":
+                self.send_json([one(call) for call in reversed(body)])
+            elif self.reply == "no batch":
+                self.send_json({'jsonrpc': '2.0', 'id': None, 'error': {'code': -32700, 'message': 'Parse error'}})
+            else:
+                self.send_json({'jsonrpc': '2.0', 'id': None, 'error': {'code': -32000, 'message': 'Server error'}})
+
+    with StubServer(StubNode) as url:
+        queries = [{"account_id": "a%d" % i} for i in range(250)]
+        for reply in ("batch", "no batch"):
+            StubNode.reply = reply
+            provider = SpecialNodeJsonProvider(url)
+            if [r['echo'] for r in provider.query_batch(queries)] != [q['account_id'] for q in queries]:
+                return False
+            results = provider.query_batch(queries[:3] + [{"account_id": "bad"}], return_errors=True)
+            if not isinstance(results[3], SpecialNodeJsonProviderError) or results[0]['echo'] != 'a0':
+                return False
+            if provider._batch_supported != (reply == "batch"):
+                return False
+        # any other error of a whole batch is raised, and batches are still sent
+        StubNode.reply = "error"
+        provider = SpecialNodeJsonProvider(url)
+        try:
+            provider.query_batch(queries)
+            return False
+        except SpecialNodeJsonProviderError as e:
+            if e.args[0]['code'] != -32000:
+                return False
+        return provider._batch_supported
+
+# python near_special_rpc.py check
+def self_check():
+    run_self_checks([("batch", batch_self_check)])
+
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    import sys
+    if sys.argv[1:] == ["check"]:
+        self_check()
@@ -0,0 +1,246 @@
+# Raw contract state dumps of view_state, streamed from the rpc response to disk.
+# A dump is <basepath>.ndjson.gz with one {"key", "value"} entry per line, and <basepath>.manifest.json
+# with the entry count, block and query. The manifest is written last, so a dump without one is incomplete.
+
+import os
+import gzip
+import re
+import json
+import codecs
+
+from near_special_rpc import SpecialNodeJsonProviderError
+from check_helpers import run_self_checks
+
+
+WHITESPACE = re.compile(r'[ \t\r\n]*')
+
+# Reads json values one at a time from a stream of byte chunks, so a large document never sits in memory whole.
+class JsonChunkReader(object):
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+
+    def fill(self):
+        for chunk in self.chunks:
+            text = self.utf8.decode(chunk)
+            if text:
+                self.buf = self.buf[self.pos:] + text
+                self.pos = 0
+                return True
+        return False
+
+    # next non blank character, left unread
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise Exception("Unexpected end of json stream")
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise Exception("Expected %s in json stream, got %s" % (c, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                (value, end) = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # a number ending the buffer may go on in the next chunk
+            if end == len(self.buf) and isinstance(value, (int, float)) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    # yield the keys of an object, the caller reads the value of each before the next key
+    def iter_members(self):
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            yield key
+            c = self.peek()
+            self.pos += 1
+            if c == '}':
+                return
+            if c != ',':
+                raise Exception("Expected , or } in json stream, got %s" % c)
+
+    def iter_values(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            c = self.peek()
+            self.pos += 1
+            if c == ']':
+                return
+            if c != ',':
+                raise Exception("Expected , or ] in json stream, got %s" % c)
+
+
+# Iterate the values of a view_state json-rpc response.
+# @param result: filled with the other fields of the result, block_height and block_hash,
+#                and 'values' True once the values are read
+def iter_view_state(chunks, result: dict):
+    reader = JsonChunkReader(chunks)
+    for key in reader.iter_members():
+        if key == 'result':
+            for result_key in reader.iter_members():
+                if result_key == 'values':
+                    for value in reader.iter_values():
+                        yield value
+                    result['values'] = True
+                else:
+                    result[result_key] = reader.read_value()
+        elif key == 'error':
+            raise SpecialNodeJsonProviderError(reader.read_value())
+        else:
+            reader.read_value()
+
+
+def get_dump_filepath(basepath):
+    return basepath + '.ndjson.gz'
+
+def get_manifest_filepath(basepath):
+    return basepath + '.manifest.json'
+
+# @return manifest of a complete dump, None if there is none
+def read_state_manifest(basepath):
+    filepath = get_manifest_filepath(basepath)
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath, mode='r', encoding="utf-8") as f:
+        return json.load(f)
+
+# iterate the {"key", "value"} entries of a dump
+def iter_state_dump(basepath):
+    with gzip.open(get_dump_filepath(basepath), mode='rt', encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class StateDumpWriter(object):
+
+    def __init__(self, basepath):
+        self.basepath = basepath
+        self.count = 0
+        self.encoder = json.JSONEncoder(separators=(',', ':'))
+        # lines not written yet, written in batches as gzip is slow on many small writes
+        self.lines = []
+        self.f = gzip.open(get_dump_filepath(basepath) + '.tmp', mode='wt', encoding="utf-8", compresslevel=6)
+
+    def write(self, entry):
+        self.lines.append(self.encoder.encode(entry))
+        self.count += 1
+        if len(self.lines) >= 10000:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.lines.append('')
+            self.f.write('\n'.join(self.lines))
+            self.lines = []
+
+    def abort(self):
+        self.f.close()
+        os.remove(get_dump_filepath(self.basepath) + '.tmp')
+
+    # @param manifest: saved with the entry count added
+    def close(self, manifest: dict):
+        self.flush()
+        self.f.close()
+        os.replace(get_dump_filepath(self.basepath) + '.tmp', get_dump_filepath(self.basepath))
+        manifest = dict(manifest, count=self.count)
+        filepath = get_manifest_filepath(self.basepath)
+        with open(filepath + '.tmp', mode='w', encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(filepath + '.tmp', filepath)
+        print("%s saved" % get_dump_filepath(self.basepath))
+        return manifest
+
+
+# Stream a view_state query of conn, a SpecialNodeJsonProvider, into the dump at basepath.
+# @return its manifest
+def save_view_state(conn, query_args: dict, basepath):
+    response = conn.json_rpc_stream('query', query_args)
+    result = {}
+    writer = StateDumpWriter(basepath)
+    try:
+        for entry in iter_view_state(response.iter_content(chunk_size=1 << 20), result):
+            writer.write(entry)
+        # older nodes answer a failed query, e.g. a state too large to be viewed, with a result holding an error
+        if 'error' in result:
+            raise SpecialNodeJsonProviderError(result['error'])
+        if 'values' not in result:
+            raise SpecialNodeJsonProviderError("view_state result without values")
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        response.close()
+    return writer.close({"block_height": result.get('block_height'), "block_hash": result.get('block_hash'), "query": query_args})
+
+
+# save_view_state of a stub node answering with values, a legacy error result, or a result without values
+def view_state_self_check():
+    import random
+    import tempfile
+
+    class StubResponse(object):
+        def __init__(self, body):
+            self.body = body
+
+        def iter_content(self, chunk_size):
+            cuts = sorted(random.sample(range(1, len(self.body)), 20))
+            return [self.body[a:b] for (a, b) in zip([0] + cuts, cuts + [len(self.body)])]
+
+        def close(self):
+            pass
+
+    class StubNode(object):
+        def __init__(self, result):
+            self.body = json.dumps({"jsonrpc": "2.0", "result": result, "id": 0}).encode()
+
+        def json_rpc_stream(self, method, params):
+            return StubResponse(self.body)
+
+    random.seed(1)
+    values = [{"key": "a2V5%d" % i, "value": "dmFsdWU="} for i in range(100)]
+    basepath = os.path.join(tempfile.mkdtemp(), "state")
+    for result in ({"error": "wasm execution failed with error: state too large to be viewed", "logs": [], "block_height": 7, "block_hash": "h"},
+                   {"block_height": 7, "block_hash": "h"}):
+        try:
+            save_view_state(StubNode(result), {"request_type": "view_state"}, basepath)
+            return False
+        except SpecialNodeJsonProviderError:
+            pass
+        if read_state_manifest(basepath) is not None or os.path.exists(get_dump_filepath(basepath)):
+            return False
+    manifest = save_view_state(StubNode({"values": values, "proof": [], "block_height": 7, "block_hash": "h"}), {"request_type": "view_state"}, basepath)
+    return manifest['count'] == len(values) and read_state_manifest(basepath) == manifest and list(iter_state_dump(basepath)) == values
+
+
+# python state_dump.py check
+def self_check():
+    run_self_checks([("view_state", view_state_self_check)])
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["check"]:
+        self_check()
@@ -1,8 +1,14 @@
 from near_special_rpc import SpecialNodeJsonProviderError,  SpecialNodeJsonProvider
+from check_helpers import StubHandler, StubServer, run_self_checks
+from state_dump import JsonChunkReader, read_state_manifest, save_view_state, iter_state_dump, StateDumpWriter, get_dump_filepath, get_manifest_filepath
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from base64 import b64encode, b64decode
 import json
 import os
 import time
+import asyncio
+import bisect
+import requests
 
 from config import Cfg
 
@@ -12,6 +18,18 @@ from config import Cfg
 RPC_ENDPOINT = "http://161.117.178.13:3030"
 #RPC_ENDPOINT = "https://rpc.testnet.near.org" # test net
 
+rpc_provider = None
+rpc_provider_pid = None
+
+# provider of RPC_ENDPOINT shared by the helpers below, so they reuse its keep-alive connections.
+# a forked process gets a provider of its own instead of the sockets of its parent.
+def get_rpc_provider():
+    global rpc_provider, rpc_provider_pid
+    if rpc_provider is None or rpc_provider_pid != os.getpid():
+        rpc_provider = SpecialNodeJsonProvider(RPC_ENDPOINT)
+        rpc_provider_pid = os.getpid()
+    return rpc_provider
+
 def sort_dict(item: dict):
     for k, v in sorted(item.items()):
         item[k] = sorted(v) if isinstance(v, list) else v
@@ -29,6 +47,47 @@ def OpenFile(filepath):
       json_obj = json.load(f)
    return json_obj
 
+# Run-length encode the per-point stats of a pool, as returned by PointInfo.dump_stats_data.
+# Returns [[left, right, stats], ...] in ascending order, where stats applies to
+# every point in range(left, right, point_delta).
+def encode_stats_runs(stats_dict: dict, point_delta: int):
+    runs = []
+    for point in sorted(int(key) for key in stats_dict.keys()):
+        stats = stats_dict[str(point)]
+        if runs and runs[-1][1] == point and (runs[-1][2] is stats or runs[-1][2] == stats):
+            runs[-1][1] = point + point_delta
+        else:
+            runs.append([point, point + point_delta, stats])
+    return runs
+
+# Reader of the run-length encoded endpoint stats written by Dcl.dump_pools_stats_data(run_length = True)
+class EndpointStatsRuns:
+    def __init__(self, filepath = './dcl_endpoint_stats_rle.json'):
+        self.pools = OpenFile(filepath)
+        self.lefts = {}
+        for pool_id, pool_stats in self.pools.items():
+            self.lefts[pool_id] = [run[0] for run in pool_stats['ranges']]
+
+    # return stats of the point, None if the point has no stats
+    def get_point_stats(self, pool_id: str, point: int):
+        pool_stats = self.pools[pool_id]
+        i = bisect.bisect_right(self.lefts[pool_id], point) - 1
+        if i < 0:
+            return None
+        (left, right, stats) = pool_stats['ranges'][i]
+        if point < right and (point - left) % pool_stats['point_delta'] == 0:
+            return stats
+        return None
+
+    # expand a pool back to the per-point shape of dcl_endpoint_stats.json
+    def expand(self, pool_id: str):
+        pool_stats = self.pools[pool_id]
+        stats_dict = {}
+        for (left, right, stats) in pool_stats['ranges']:
+            for point in range(left, right, pool_stats['point_delta']):
+                stats_dict[str(point)] = stats
+        return stats_dict
+
 def open_info_file(filename):
     filepath = "output/height_%s/%s.json" % (Cfg.BLOCK_ID, filename)
     if os.path.exists(filepath):
@@ -41,13 +100,13 @@ def open_info_file(filename):
         print("[WARNING] file %s not exist, consider genrate them first." % filepath)
         raise Exception("File not exist. %s" % (filepath, )) 
 
-def gen_rawdata_filepath(filename):
+def gen_rawdata_filepath(filename, ext=".json"):
     # if dir not exist, create it
     filepath = "data/height_%s" % (Cfg.BLOCK_ID, )
     if not os.path.exists(filepath):
         print("[WARNING]Path not exist, create %s" % filepath)
         os.makedirs(filepath)
-    return "%s/%s.json" % (filepath, filename)
+    return "%s/%s%s" % (filepath, filename, ext)
 
 
 def gen_info_filepath(filename):
@@ -71,7 +130,7 @@ def save2file(filename, json_obj, info=True, sort_keys=False):
 def get_last_block_height():
     ret = ""
     try:
-        conn = SpecialNodeJsonProvider(RPC_ENDPOINT)
+        conn = get_rpc_provider()
         ret = conn.get_start_block()
 
     except SpecialNodeJsonProviderError as e:
@@ -95,7 +154,7 @@ def fetch_state(contract_id, prefix, filename=None):
         "prefix_base64": prefix_key.decode(),
     }
     try:
-        conn = SpecialNodeJsonProvider(RPC_ENDPOINT)
+        conn = get_rpc_provider()
         ret = conn.query(query_args)
         count = len(ret['values'])
         if filename:
@@ -108,18 +167,21 @@ def fetch_state(contract_id, prefix, filename=None):
     return count
 
 
+# The state streams into the dump data/height_<BLOCK_ID>/<filename>.ndjson.gz, see state_dump.
+# @return count of the state entries
 def fetch_state_at_height(height, contract_id, prefix, filename):
-    count = 0
     # skip if rawdata already exit
-    filepath = gen_rawdata_filepath(filename)
-    if os.path.exists(filepath):
-        json_obj = None
-        with open(filepath, mode='r', encoding="utf-8") as f:
-            json_obj = json.load(f)
-        if json_obj is not None and 'values' in json_obj:
-            count = len(json_obj['values'])
-        return count
+    basepath = gen_rawdata_filepath(filename, ext="")
+    manifest = read_state_manifest(basepath)
+    if manifest is not None:
+        return manifest['count']
+
+    return save_state_at_height(height, contract_id, prefix, basepath)['count']
 
+# stream the state of contract_id under prefix at height into the dump at basepath, retrying on failure
+# @param conn: SpecialNodeJsonProvider to use, None for a new one of get_rpc_provider per try
+# @return manifest of the dump
+def save_state_at_height(height, contract_id, prefix, basepath, conn=None):
     prefix_key = b''
     if prefix:
         prefix_key = b64encode(prefix)
@@ -131,34 +193,74 @@ def fetch_state_at_height(height, contract_id, prefix, filename):
         "prefix_base64": prefix_key.decode(),
     }
 
-    flag = False
     for i in range(10):
         if i > 0:
             print("Retry after %d seconds ..." % i)
             time.sleep(i)
         try:
-            conn = SpecialNodeJsonProvider(RPC_ENDPOINT)
-            ret = conn.query(query_args)
-            count = len(ret['values'])
-            if filename:
-                save2file(filename, ret, info=False)
-            flag = True
-            break
+            return save_view_state(conn if conn is not None else get_rpc_provider(), query_args, basepath)
         except SpecialNodeJsonProviderError as e:
             print("RPC Error: ", e)
         except Exception as e:
             print("Error: ", e)
 
-    if not flag:
-        raise Exception("Error fetch state on %s to get %s" %
-                        (contract_id, filename))
-
-    return count
+    raise Exception("Error fetch state on %s to get %s" %
+                    (contract_id, basepath))
+
+# Same dump as fetch_state_at_height of the whole contract state, fetched as one view_state per first key byte.
+# The shards are fetched concurrently and retried on their own, a finished shard is kept on disk
+# and not fetched again by a later call, then they are merged in key order as the node returns each in key order.
+# Only the whole state can be sharded: under a non-empty prefix, a key equal to the prefix itself, e.g. a near-sdk
+# LazyOption value, is in no shard, and view_state can't fetch that one key without all the others.
+# @param prefix: must be empty, use fetch_state_at_height for the state under a prefix
+# @param height: None for the final block, taken once so every shard reads the same block
+# @param shard_bytes: first key bytes that have keys, e.g. the storage key tags of the contract, in any order
+# @return count of the state entries
+def fetch_sharded_state_at_height(height, contract_id, prefix, filename, shard_bytes=range(256), max_workers=8):
+    if prefix:
+        raise Exception("Sharded fetch of %s state under prefix %s would miss the key equal to the prefix" % (contract_id, prefix))
+    shard_bytes = list(shard_bytes)
+    if any(not isinstance(b, int) or b < 0 or b > 255 for b in shard_bytes):
+        raise Exception("Invalid shard bytes %s, each must be in range(256)" % shard_bytes)
+    # shards are merged in the order of shard_bytes, so it must be ascending without duplicates
+    shard_bytes = sorted(set(shard_bytes))
+    basepath = gen_rawdata_filepath(filename, ext="")
+    manifest = read_state_manifest(basepath)
+    if manifest is not None:
+        return manifest['count']
+
+    if height is None:
+        height = get_rpc_provider().get_start_block()['header']['height']
+        # pass it as height to resume a failed fetch from its shards
+        print("fetch %s from final block %s" % (filename, height))
+    shard_basepaths = ["%s.shard_%d_%02x" % (basepath, height, b) for b in shard_bytes]
+
+    def fetch_shard(b, shard_basepath):
+        shard_manifest = read_state_manifest(shard_basepath)
+        if shard_manifest is None:
+            shard_manifest = save_state_at_height(height, contract_id, bytes([b]), shard_basepath)
+        return shard_manifest
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_shard, b, shard_basepath) for b, shard_basepath in zip(shard_bytes, shard_basepaths)]
+        shard_manifests = [future.result() for future in futures]
+
+    writer = StateDumpWriter(basepath)
+    for shard_basepath in shard_basepaths:
+        for entry in iter_state_dump(shard_basepath):
+            writer.write(entry)
+    manifest = writer.close({"block_height": height, "block_hash": shard_manifests[0]['block_hash'] if shard_manifests else None,
+                             "query": {"request_type": "view_state", "block_id": height, "account_id": contract_id,
+                                       "prefix_base64": "", "shard_bytes": list(shard_bytes)}})
+    for shard_basepath in shard_basepaths:
+        os.remove(get_dump_filepath(shard_basepath))
+        os.remove(get_manifest_filepath(shard_basepath))
+    return manifest['count']
 
 def get_user_liquidity(contract_id, lpt_id):
     query_args = {"lpt_id": lpt_id}
     try:
-        conn = SpecialNodeJsonProvider(RPC_ENDPOINT)
+        conn = get_rpc_provider()
         ret = conn.view_call(account_id=contract_id, method_name = "get_liquidity", args=json.dumps(query_args).encode('utf8'))
         ret['result'] = json.loads(''.join([chr(x) for x in ret['result']]))
         return ret['result']
@@ -172,7 +274,7 @@ def get_user_liquidity(contract_id, lpt_id):
 def get_ft_metadata(contract_id):
     query_args = {}
     try:
-        conn = SpecialNodeJsonProvider(RPC_ENDPOINT)
+        conn = get_rpc_provider()
         ret = conn.view_call(account_id=contract_id, method_name = "ft_metadata", args=json.dumps(query_args).encode('utf8'))
         ret['result'] = json.loads(''.join([chr(x) for x in ret['result']]))
         return ret['result']
@@ -183,6 +285,56 @@ def get_ft_metadata(contract_id):
 
     return None
 
+# Token metadata kept in memory and in a json file, so loading pools doesn't ask the rpc for every token.
+# An entry older than ttl seconds is fetched again, offline never fetches and fails on a token not cached yet.
+class FtMetadataCache:
+    def __init__(self, filepath = './ft_metadata_cache.json', ttl = 7 * 24 * 3600, offline = False):
+        self.filepath = filepath
+        self.ttl = ttl
+        self.offline = offline
+        # token_id -> {"decimals", "symbol", "fetched_at"}
+        self.entries = None
+
+    def load(self):
+        self.entries = {}
+        if os.path.exists(self.filepath):
+            self.entries = OpenFile(self.filepath)
+
+    def save(self):
+        with open(self.filepath + ".tmp", mode='w', encoding="utf-8") as f:
+            json.dump(self.entries, f, indent = 2, sort_keys = True)
+        os.replace(self.filepath + ".tmp", self.filepath)
+
+    def get(self, token_id):
+        if self.entries is None:
+            self.load()
+        entry = self.entries.get(token_id)
+        if entry is not None and (self.offline or time.time() - entry['fetched_at'] < self.ttl):
+            return entry
+        if self.offline:
+            raise Exception("No cached ft metadata of %s in offline mode" % (token_id, ))
+
+        metadata = get_ft_metadata(token_id)
+        if metadata is None:
+            if entry is not None:
+                print("[WARNING] use expired ft metadata of %s" % token_id)
+                return entry
+            raise Exception("Error fetch ft metadata of %s" % (token_id, ))
+        entry = {"decimals": metadata['decimals'], "symbol": metadata.get('symbol'), "fetched_at": int(time.time())}
+        self.entries[token_id] = entry
+        self.save()
+        return entry
+
+ft_metadata_cache = None
+
+# get_ft_metadata through the FtMetadataCache set up from Cfg.FT_METADATA_*
+# @return {"decimals", "symbol", "fetched_at"}
+def get_cached_ft_metadata(token_id):
+    global ft_metadata_cache
+    if ft_metadata_cache is None:
+        ft_metadata_cache = FtMetadataCache(Cfg.FT_METADATA_CACHE, Cfg.FT_METADATA_TTL, Cfg.FT_METADATA_OFFLINE)
+    return ft_metadata_cache.get(token_id)
+
 def fetch_ft_balance_at_height(token_id, account_id, height):
     ret = None
 
@@ -190,7 +342,7 @@ def fetch_ft_balance_at_height(token_id, account_id, height):
 
     try:
         #conn = JsonProvider(("172.21.120.89", 3030))
-        conn = SpecialNodeJsonProvider(RPC_ENDPOINT)
+        conn = get_rpc_provider()
         ret = conn.view_call_at_height(token_id, "ft_balance_of", bytes('{"account_id": "%s"}' % account_id, encoding='utf-8'), height)
         flag = True
     except SpecialNodeJsonProviderError as e:
@@ -202,7 +354,176 @@ def fetch_ft_balance_at_height(token_id, account_id, height):
         raise Exception("Error fetch %s balance for %s on %s" %
                         (token_id, account_id, height))
 
-    return b''.join(map(lambda x:int.to_bytes(x,1,'little'), ret['result']))[1:-1]
+    return bytes(ret['result'])[1:-1]
+
+# ft_balance_of token_id for account_id at height with conn, retried up to retries times
+# @return the balance as int
+def fetch_ft_balance_with_retry(conn, token_id, account_id, height, retries=5):
+    for i in range(retries):
+        if i > 0:
+            print("Retry after %d seconds ..." % i)
+            time.sleep(i)
+        try:
+            ret = conn.view_call_at_height(token_id, "ft_balance_of", json.dumps({"account_id": account_id}).encode('utf8'), height)
+            return int(json.loads(bytes(ret['result'])))
+        except SpecialNodeJsonProviderError as e:
+            print("RPC Error: ", e)
+        except Exception as e:
+            print("Error: ", e)
+
+    raise Exception("Error fetch %s balance for %s on %s" %
+                    (token_id, account_id, height))
+
+# Balances of many (token_id, account_id) pairs at height, fetched on max_workers threads with a retry per pair.
+# Fetched balances are kept in cache_dir/ft_balances_<height>.json, also when some pair fails,
+# so a later call at the same height only fetches the pairs not cached yet.
+# @return {"token_id": [...], "account_id": [...], "balance": [int, ...]} in the order of pairs
+def fetch_ft_balances_at_height(height, pairs, max_workers=16, cache_dir='./ft_balance_cache'):
+    filepath = "%s/ft_balances_%s.json" % (cache_dir, height)
+    # token_id -> account_id -> balance as str
+    cache = {}
+    if os.path.exists(filepath):
+        cache = OpenFile(filepath)
+
+    missing = sorted({(token_id, account_id) for (token_id, account_id) in pairs if account_id not in cache.get(token_id, {})})
+    error = None
+    if len(missing) > 0:
+        conn = SpecialNodeJsonProvider(RPC_ENDPOINT, pool_size=max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(fetch_ft_balance_with_retry, conn, token_id, account_id, height): (token_id, account_id) for (token_id, account_id) in missing}
+            for future in as_completed(futures):
+                (token_id, account_id) = futures[future]
+                try:
+                    cache.setdefault(token_id, {})[account_id] = str(future.result())
+                except Exception as e:
+                    error = error or e
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(filepath + ".tmp", mode='w', encoding="utf-8") as f:
+            json.dump(cache, f, sort_keys=True)
+        os.replace(filepath + ".tmp", filepath)
+        if error is not None:
+            raise error
+
+    return {
+        "token_id": [token_id for (token_id, _) in pairs],
+        "account_id": [account_id for (_, account_id) in pairs],
+        "balance": [int(cache[token_id][account_id]) for (token_id, account_id) in pairs],
+    }
+
+# Async versions of fetch_state_at_height and fetch_ft_balance_at_height, to gather many of them
+# on one near_async_rpc.AsyncSpecialNodeJsonProvider, which bounds the calls in flight.
+# fetch_state_at_height with save_state_at_height on a worker thread of conn, an AsyncSpecialNodeJsonProvider
+# @return count of the state entries
+async def fetch_state_at_height_async(conn, height, contract_id, prefix, filename):
+    # skip if rawdata already exit
+    basepath = gen_rawdata_filepath(filename, ext="")
+    manifest = read_state_manifest(basepath)
+    if manifest is not None:
+        return manifest['count']
+
+    manifest = await conn.run(lambda provider: save_state_at_height(height, contract_id, prefix, basepath, provider))
+    return manifest['count']
+
+# fetch_ft_balance_with_retry on a worker thread of conn, an AsyncSpecialNodeJsonProvider
+# @return balance as int, unlike fetch_ft_balance_at_height which returns the raw bytes of the view call
+async def fetch_ft_balance_with_retry_async(conn, token_id, account_id, height):
+    return await conn.run(fetch_ft_balance_with_retry, token_id, account_id, height)
+
+# Iterate the dcl pool events of blocks [start_block_height, end_block_height] from the indexer.
+# The range is requested blocks_per_page blocks at a time and each page is parsed from the response stream
+# one event at a time, so the caller starts on the first events right away and no page is held in memory whole.
+# A page that breaks off is requested again, skipping the events already yielded from it.
+def iter_dcl_pool_log(start_block_height, end_block_height, blocks_per_page=10000, url=None, timeout=300):
+    if url is None:
+        url = Cfg.DCL_LOG_URL
+    page_start = start_block_height
+    while page_start <= end_block_height:
+        page_end = min(page_start + blocks_per_page - 1, end_block_height)
+        query_args = {"start_block_id": page_start, "end_block_id": page_end}
+        yielded = 0
+        flag = False
+        for i in range(10):
+            if i > 0:
+                print("Retry after %d seconds ..." % i)
+                time.sleep(i)
+            try:
+                with requests.get(url, params=query_args, stream=True, timeout=timeout) as r:
+                    r.raise_for_status()
+                    reader = JsonChunkReader(r.iter_content(chunk_size=1 << 16))
+                    for (n, item) in enumerate(reader.iter_values()):
+                        if n >= yielded:
+                            yielded += 1
+                            yield item
+                flag = True
+                break
+            except Exception as e:
+                print("Error: ", e)
+
+        if not flag:
+            raise Exception("Error fetch dcl pool log of blocks %s to %s" % (page_start, page_end))
+
+        page_start = page_end + 1
+
+# iter_dcl_pool_log against a local stub of the indexer, with one page broken off half way
+def dcl_pool_log_self_check():
+    import urllib.parse
+    calls = []
+
+    class StubIndexer(StubHandler):
+        # the body ends with the connection, so a page can break off
+        protocol_version = "HTTP/1.0"
+
+        def do_GET(self):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            (start, end) = (int(query['start_block_id'][0]), int(query['end_block_id'][0]))
+            calls.append((start, end))
+            body = json.dumps([{"block_id": b, "tx": "t%d" % b} for b in range(start, end + 1) if b % 3 == 0]).encode()
+            self.send_response(200)
+            self.end_headers()
+            if calls.count((start, end)) == 1 and start == 200:
+                body = body[:len(body) // 2]
+            self.wfile.write(body)
+
+    with StubServer(StubIndexer) as url:
+        events = iter_dcl_pool_log(100, 1050, 100, url + "/get-dcl-pool-log", timeout=10)
+        first = next(events)
+        # pages are requested as the events are consumed
+        if calls != [(100, 199)]:
+            return False
+        blocks = [first["block_id"]] + [e["block_id"] for e in events]
+        return blocks == [b for b in range(100, 1051) if b % 3 == 0] and len(calls) == 11 and calls[-1] == (1000, 1050)
+
+# fetch_ft_balance_with_retry_async against a local stub node, with a call failing once
+def ft_balance_async_self_check():
+    from near_async_rpc import AsyncSpecialNodeJsonProvider
+    calls = []
+
+    class StubNode(StubHandler):
+        def do_POST(self):
+            call = self.read_json()
+            account_id = json.loads(b64decode(call['params']['args_base64']))['account_id']
+            calls.append(account_id)
+            if account_id == "flaky" and calls.count(account_id) == 1:
+                out = {'error': {'name': 'HANDLER_ERROR', 'cause': {'name': 'UNKNOWN_BLOCK'}}}
+            else:
+                out = {'result': {'result': list(json.dumps(str(10**24 + len(account_id))).encode()), 'block_height': call['params']['block_id']}}
+            self.send_json(dict(out, jsonrpc='2.0', id=call['id']))
+
+    async def fetch(url, account_ids):
+        async with AsyncSpecialNodeJsonProvider(url, max_concurrency=4) as conn:
+            return await asyncio.gather(*[fetch_ft_balance_with_retry_async(conn, "token.near", account_id, 100) for account_id in account_ids])
+
+    with StubServer(StubNode) as url:
+        account_ids = ["a%d.near" % i for i in range(20)] + ["flaky"]
+        balances = asyncio.run(fetch(url, account_ids))
+        return balances == [10**24 + len(account_id) for account_id in account_ids] and calls.count("flaky") == 2
+
+# python utils.py check
+def self_check():
+    run_self_checks([("dcl_pool_log", dcl_pool_log_self_check), ("ft_balance_async", ft_balance_async_self_check)])
 
 if __name__ == '__main__':
-    pass
+    import sys
+    if sys.argv[1:] == ["check"]:
+        self_check()